@@ -0,0 +1,313 @@
+from argparse import ArgumentParser
+from itertools import chain
+from multiprocessing import cpu_count
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from config import read_config, DEFAULT_CONFIG_FILE
+from data_utils import (augment_utterance,
+                        create_contexts,
+                        iterate_dataset_rows,
+                        make_vocabulary,
+                        make_windowed_input,
+                        pad_sequences,
+                        vectorize_dataset,
+                        vectorize_sequences)
+from dialogue_denoiser_lstm import create_model, create_prediction_ops, load, predict
+from numpy_model import export_numpy_model, NumpyModel
+from pos_tag_dataset import (get_pos_tagger,
+                             pos_tag_batch,
+                             pos_tag_parallel,
+                             IncrementalPOSTagger,
+                             DEFAULT_BATCH_SIZE,
+                             POS_CACHE)
+from session_utils import create_session
+from training_utils import get_loss_function
+
+LABEL_VOCABULARY_SIZE = 30
+LARGE_BATCH_SIZE = 1024
+ENTRY_POINTS = ['denoise_lstm',
+                'predict',
+                'evaluate',
+                'train',
+                'post_train_lm',
+                'sweep',
+                'pos_tag_dataset',
+                'numpy_model',
+                'frozen_model',
+                'quantize_model']
+HEAVY_MODULES = ['tensorflow', 'tensorflow.contrib', 'sklearn', 'pandas', 'nltk', 'deep_disfluency']
+IMPORT_RUNS = 5
+# time_thread_setting() in a new process: config json, steps, intra_op_threads, inter_op_threads
+THREAD_SETTING_SCRIPT = ('import json, sys; from benchmark import time_thread_setting; '
+                         'print json.dumps(time_thread_setting(json.loads(sys.argv[1]), *map(int, sys.argv[2:])))')
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Benchmark the LSTM dialogue filter on synthetic data')
+    parser.add_argument('mode', help='[lm_loss/contexts/threads/numpy/imports/pos_tag/pos_stream]')
+    parser.add_argument('--config', default=DEFAULT_CONFIG_FILE)
+    parser.add_argument('--dataset', help='dataset json file (e.g. the Switchboard trainset.json)')
+    parser.add_argument('--model_folder', help='trained model for the numpy mode')
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=None, help='overrides the config batch_size')
+
+    return parser
+
+
+def run_steps(in_session, in_op, in_feed_dict, in_steps, warmup_steps=10):
+    for _ in xrange(warmup_steps):
+        in_session.run(in_op, feed_dict=in_feed_dict)
+    start = time.time()
+    for _ in xrange(in_steps):
+        in_session.run(in_op, feed_dict=in_feed_dict)
+    return in_steps / (time.time() - start)
+
+
+def benchmark_lm_loss(in_config, in_steps):
+    """Training steps/sec of the tag+lm model with the full vs sampled LM softmax"""
+    vocab_size = in_config['max_vocabulary_size']
+    task_output_dimensions = [LABEL_VOCABULARY_SIZE, vocab_size]
+    X_batch = np.random.randint(0, vocab_size, size=(in_config['batch_size'], in_config['max_input_length']))
+    ys_batch = [np.random.randint(0, LABEL_VOCABULARY_SIZE, size=in_config['batch_size']),
+                np.random.randint(0, vocab_size, size=in_config['batch_size'])]
+    for lm_loss in ['softmax', 'sampled_softmax', 'nce']:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            X, ys_for_tasks, logits_for_tasks, hidden = create_model(vocab_size,
+                                                                     in_config['embedding_size'],
+                                                                     in_config['max_input_length'],
+                                                                     task_output_dimensions)
+            loss_op = get_loss_function(logits_for_tasks,
+                                        ys_for_tasks,
+                                        [np.ones(dim) for dim in task_output_dimensions],
+                                        l2_coef=in_config['l2_coef'],
+                                        task_weights=in_config['task_weights'],
+                                        task_losses=['softmax', lm_loss],
+                                        num_sampled=in_config.get('lm_num_sampled', 512),
+                                        hidden=hidden)
+            train_op = tf.train.GradientDescentOptimizer(in_config['lr']).minimize(loss_op)
+            sess.run(tf.global_variables_initializer())
+            steps_per_sec = run_steps(sess, train_op, {X: X_batch, ys_for_tasks: ys_batch}, in_steps)
+        print '{}:\t{:.1f} steps/sec'.format(lm_loss, steps_per_sec)
+
+
+def benchmark_contexts(in_config, in_dataset_file):
+    """Time to build the windowed model input of a dataset: per-token contexts vs vectorised strided windows"""
+    dataset = pd.read_json(in_dataset_file)
+    utterances = [augment_utterance(tokens, pos, in_config)
+                  for tokens, pos, tags in iterate_dataset_rows(dataset)]
+    vocab, _ = make_vocabulary(utterances, in_config['max_vocabulary_size'])
+
+    start = time.time()
+    contexts = []
+    for utterance in utterances:
+        contexts += create_contexts(utterance, in_config['max_input_length'])
+    X_contexts = pad_sequences(vectorize_sequences(contexts, vocab), in_config['max_input_length'])
+    contexts_time = time.time() - start
+
+    start = time.time()
+    X_windows = make_windowed_input(utterances, vocab, in_config)
+    windows_time = time.time() - start
+
+    assert np.array_equal(X_contexts, X_windows)
+    print '{} tokens'.format(X_windows.shape[0])
+    print 'create_contexts + pad_sequences:\t{:.3f} sec'.format(contexts_time)
+    print 'make_windowed_input:\t{:.3f} sec ({:.1f}x)'.format(windows_time, contexts_time / windows_time)
+
+
+def time_thread_setting(in_config, in_steps, in_intra_op_threads, in_inter_op_threads):
+    """(batch=1 latency in ms, batch=LARGE_BATCH_SIZE tokens/sec) of a session with the thread setting"""
+    vocab_size = in_config['max_vocabulary_size']
+    X_large_batch = np.random.randint(0, vocab_size, size=(LARGE_BATCH_SIZE, in_config['max_input_length']))
+    X_single = X_large_batch[:1]
+    with tf.Graph().as_default() as graph:
+        model = create_model(vocab_size,
+                             in_config['embedding_size'],
+                             in_config['max_input_length'],
+                             [LABEL_VOCABULARY_SIZE, vocab_size])
+        y_pred_op = create_prediction_ops(model)['y_pred'][0]
+        init = tf.global_variables_initializer()
+    X = model[0]
+    session_settings = {'intra_op_threads': in_intra_op_threads, 'inter_op_threads': in_inter_op_threads}
+    with create_session(session_settings, graph=graph) as sess:
+        sess.run(init)
+        latency = 1000.0 / run_steps(sess, y_pred_op, {X: X_single}, in_steps)
+        throughput = LARGE_BATCH_SIZE * run_steps(sess, y_pred_op, {X: X_large_batch}, max(in_steps / 10, 1))
+    return latency, throughput
+
+
+def benchmark_threads(in_config, in_steps):
+    """Tagging latency at batch size 1 and throughput at LARGE_BATCH_SIZE
+    for different intra/inter-op thread settings of the session. TF creates its intra-op thread pool
+    once per process with the first session's setting, so every setting is timed in a new process"""
+    cores = cpu_count()
+    thread_settings = sorted(set([(1, 1), (2, 1), (cores / 2 or 1, 1), (cores, 1), (cores / 2 or 1, 2), (0, 0)]))
+    print 'intra_op\tinter_op\tbatch=1 latency, ms\tbatch={} tokens/sec'.format(LARGE_BATCH_SIZE)
+    for intra_op_threads, inter_op_threads in thread_settings:
+        output = subprocess.check_output([sys.executable,
+                                          '-c',
+                                          THREAD_SETTING_SCRIPT,
+                                          json.dumps(in_config),
+                                          str(in_steps),
+                                          str(intra_op_threads),
+                                          str(inter_op_threads)])
+        latency, throughput = json.loads(output.strip().splitlines()[-1])
+        print '{}\t{}\t{:.2f}\t{:.0f}'.format(intra_op_threads or 'all', inter_op_threads or 'all', latency, throughput)
+
+
+def time_import(in_module_name):
+    """Cold start: the time for a new Python process to import the module"""
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import ' + in_module_name])
+    return time.time() - start
+
+
+def get_heavy_imports(in_module_name):
+    """HEAVY_MODULES loaded by importing the module in a new Python process"""
+    script = 'import sys; import {}; print " ".join(name for name in {!r} if name in sys.modules)'
+    return subprocess.check_output([sys.executable, '-c', script.format(in_module_name, HEAVY_MODULES)]).split()
+
+
+def benchmark_imports(in_runs=IMPORT_RUNS):
+    """Cold start of the entry points: the best of in_runs imports, over the bare interpreter startup,
+    and the heavy dependencies each one loads"""
+    interpreter_time = min(time_import('sys') for _ in xrange(in_runs))
+    print 'Interpreter startup: {:.3f} sec'.format(interpreter_time)
+    print 'module\timport, sec\theavy modules loaded'
+    for module_name in ENTRY_POINTS:
+        try:
+            import_time = min(time_import(module_name) for _ in xrange(in_runs)) - interpreter_time
+            heavy_imports = get_heavy_imports(module_name)
+        except subprocess.CalledProcessError:
+            print '{}\tfailed'.format(module_name)
+            continue
+        print '{}\t{:.3f}\t{}'.format(module_name, import_time, ', '.join(heavy_imports) or '-')
+
+
+def benchmark_numpy_backend(in_model_folder, in_dataset_file):
+    """Load and predict timings of the NumPy backend vs TF predict() on a dataset
+    (their parity is checked by test_models.py)"""
+    dataset = pd.read_json(in_dataset_file)
+    export_folder = tempfile.mkdtemp()
+    try:
+        export_numpy_model(in_model_folder, export_folder)
+        start = time.time()
+        numpy_model = NumpyModel(export_folder)
+        numpy_load_time = time.time() - start
+    finally:
+        shutil.rmtree(export_folder)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        start = time.time()
+        model, config, vocab, char_vocab, label_vocab = load(in_model_folder, sess)
+        tf_load_time = time.time() - start
+        rev_label_vocab = {label_id: label
+                           for label, label_id in label_vocab.iteritems()}
+        X, ys = vectorize_dataset(dataset, vocab, label_vocab, config)
+
+        start = time.time()
+        predict(model, (X, ys), [(vocab, label_vocab, rev_label_vocab)], sess, batch_size=1024)
+        tf_predict_time = time.time() - start
+        start = time.time()
+        numpy_model.predict(X)
+        numpy_predict_time = time.time() - start
+
+    print 'backend\timport, sec\tload, sec\tpredict, sec'
+    print 'TensorFlow\t{:.3f}\t{:.3f}\t{:.3f}'.format(time_import('tensorflow'), tf_load_time, tf_predict_time)
+    print 'NumPy\t{:.3f}\t{:.3f}\t{:.3f}'.format(time_import('numpy_model'), numpy_load_time, numpy_predict_time)
+
+
+def benchmark_pos_tagging(in_dataset_file, processes_number=cpu_count()):
+    """Throughput of the POS tagger in utterances/sec: one utterance at a time, tag_sents() batches,
+    the warm LRU cache and the process pool"""
+    utterances = list(pd.read_json(in_dataset_file)['utterance'])
+    batches = [utterances[batch_start: batch_start + DEFAULT_BATCH_SIZE]
+               for batch_start in xrange(0, len(utterances), DEFAULT_BATCH_SIZE)]
+    get_pos_tagger()
+
+    print 'mode\tutterances/sec'
+    start = time.time()
+    pos_single = [pos_tag_batch([utterance], use_cache=False)[0] for utterance in utterances]
+    print 'single\t{:.0f}'.format(len(utterances) / (time.time() - start))
+    start = time.time()
+    pos_batched = list(chain.from_iterable(pos_tag_batch(batch, use_cache=False) for batch in batches))
+    print 'batched\t{:.0f}'.format(len(utterances) / (time.time() - start))
+    assert pos_batched == pos_single, 'batched POS tags differ'
+
+    POS_CACHE.clear()
+    for batch in batches:
+        pos_tag_batch(batch)
+    start = time.time()
+    pos_cached = list(chain.from_iterable(pos_tag_batch(batch) for batch in batches))
+    print 'cached\t{:.0f}'.format(len(utterances) / (time.time() - start))
+    assert pos_cached == pos_single, 'cached POS tags differ'
+
+    start = time.time()
+    pos_parallel = pos_tag_parallel(utterances, processes_number)
+    print 'pool of {}\t{:.0f}'.format(processes_number, len(utterances) / (time.time() - start))
+    assert pos_parallel == pos_single, 'parallel POS tags differ'
+
+
+def benchmark_pos_streaming(in_dataset_file, right_contexts=(0, 1, 2, 4)):
+    """Per-word latency of the IncrementalPOSTagger and its agreement with the full-utterance POS tags,
+    vs re-tagging the whole utterance prefix at every word"""
+    utterances = list(pd.read_json(in_dataset_file)['utterance'])
+    pos_full = pos_tag_batch(utterances, use_cache=False)
+    words_number = sum(map(len, utterances))
+
+    print 'mode\tms/word\tagreement with full utterances'
+    start = time.time()
+    for utterance in utterances:
+        for token_idx in xrange(len(utterance)):
+            pos_tag_batch([utterance[:token_idx + 1]], use_cache=False)
+    print 'prefix re-tagging\t{:.3f}\t1.000'.format(1000.0 * (time.time() - start) / words_number)
+    for right_context in right_contexts:
+        pos_tagger = IncrementalPOSTagger(right_context=right_context)
+        agreed_number = 0
+        start = time.time()
+        for utterance, pos in zip(utterances, pos_full):
+            tagged_words = []
+            for word in utterance:
+                tagged_words += pos_tagger.push(word)
+            tagged_words += pos_tagger.flush()
+            agreed_number += sum(pos[token_idx] == tag for token_idx, word, tag in tagged_words)
+        print 'right context {}\t{:.3f}\t{:.3f}'.format(right_context,
+                                                        1000.0 * (time.time() - start) / words_number,
+                                                        agreed_number / float(words_number))
+
+
+def main(in_mode, in_config, in_steps, in_dataset_file=None, in_model_folder=None):
+    if in_mode == 'lm_loss':
+        benchmark_lm_loss(in_config, in_steps)
+    elif in_mode == 'contexts':
+        benchmark_contexts(in_config, in_dataset_file)
+    elif in_mode == 'threads':
+        benchmark_threads(in_config, in_steps)
+    elif in_mode == 'numpy':
+        benchmark_numpy_backend(in_model_folder, in_dataset_file)
+    elif in_mode == 'imports':
+        benchmark_imports()
+    elif in_mode == 'pos_tag':
+        benchmark_pos_tagging(in_dataset_file)
+    elif in_mode == 'pos_stream':
+        benchmark_pos_streaming(in_dataset_file)
+    else:
+        raise NotImplementedError
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    if args.batch_size:
+        config['batch_size'] = args.batch_size
+    main(args.mode, config, args.steps, in_dataset_file=args.dataset, in_model_folder=args.model_folder)
@@ -0,0 +1,252 @@
+import heapq
+import json
+import os
+from argparse import ArgumentParser
+from collections import Counter
+from itertools import imap, izip
+from multiprocessing import Pool, cpu_count
+from operator import itemgetter
+
+import numpy as np
+
+from config import read_config, DEFAULT_CONFIG_FILE
+from data_utils import count_dataset_rows, iterate_dataset_file, make_vocabulary_from_counts, Vocabulary
+from numpy_model import VOCABULARY_NAME, LABEL_VOCABULARY_NAME
+
+COUNTER_TYPES = ['exact', 'space_saving', 'count_min']
+# the bounded counters keep this many times max_vocabulary_size tokens by default
+DEFAULT_CAPACITY_FACTOR = 4
+SKETCH_WIDTH = 1 << 20
+SKETCH_DEPTH = 4
+SKETCH_SEED = 273
+# tokens hashed into the sketch at a time
+SKETCH_BUFFER_SIZE = 1 << 16
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class SpaceSavingCounter(object):
+    """Counts of the most frequent items in O(capacity) memory (space-saving heavy hitters).
+    Once more than 2 * capacity items are tracked, only the capacity ones of the highest guaranteed counts
+    are kept, and a new item starts from the largest count dropped so far (floor), recorded as its error.
+    The counts given by iteritems() are the guaranteed ones (count - error): never overestimated,
+    and exact for the items kept since their first occurrence"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+
+    def update(self, in_items):
+        counts, errors, floor = self.counts, self.errors, self.floor
+        for item in in_items:
+            if item in counts:
+                counts[item] += 1
+            else:
+                counts[item] = floor + 1
+                errors[item] = floor
+        if 2 * self.capacity < len(counts):
+            self._prune()
+
+    def merge(self, in_other):
+        """Adds the counts of another SpaceSavingCounter, an item missing from one side is counted
+        as that side's floor"""
+        for item in set(self.counts) | set(in_other.counts):
+            self.counts[item] = self.counts.get(item, self.floor) + in_other.counts.get(item, in_other.floor)
+            self.errors[item] = self.errors.get(item, self.floor) + in_other.errors.get(item, in_other.floor)
+        self.floor += in_other.floor
+        if 2 * self.capacity < len(self.counts):
+            self._prune()
+
+    def _prune(self):
+        kept = set(item for item, count in heapq.nlargest(self.capacity, self.iteritems(), key=itemgetter(1)))
+        self.floor = max([self.floor] + [count for item, count in self.counts.iteritems() if item not in kept])
+        self.counts = {item: self.counts[item] for item in kept}
+        self.errors = {item: self.errors[item] for item in kept}
+
+    def iteritems(self):
+        return ((item, count - self.errors[item]) for item, count in self.counts.iteritems())
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class CountMinSketchCounter(object):
+    """Counts in a depth x width count-min sketch: fixed memory whatever the number of distinct items.
+    The estimates never undercount, and overcount by at most e / width of the total count
+    with the probability of 1 - exp(-depth). The capacity items of the highest estimates are kept
+    as the vocabulary candidates, a dropped one comes back with its full count when seen again.
+    Tokens are hashed with hash(), which is the same across processes in Python 2, so the sketches
+    of the workers can be merged"""
+    def __init__(self, capacity, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=SKETCH_SEED):
+        self.capacity = capacity
+        self.width = width
+        self.seed = seed
+        random = np.random.RandomState(seed)
+        self.hash_a = random.randint(1, MERSENNE_PRIME, size=depth).astype(np.int64)
+        self.hash_b = random.randint(0, MERSENNE_PRIME, size=depth).astype(np.int64)
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.candidates = {}
+        self.buffer = []
+
+    def update(self, in_items):
+        self.buffer.extend(in_items)
+        if SKETCH_BUFFER_SIZE <= len(self.buffer):
+            self._flush()
+
+    def merge(self, in_other):
+        """Adds the counts of another CountMinSketchCounter of the same width, depth and seed"""
+        if (self.table.shape, self.seed) != (in_other.table.shape, in_other.seed):
+            raise ValueError('Only the sketches of the same shape and seed can be merged')
+        self._flush()
+        in_other._flush()
+        self.table += in_other.table
+        items = list(set(self.candidates) | set(in_other.candidates))
+        self.candidates = dict(izip(items, self._estimate(self._get_buckets(items))))
+        self._prune()
+
+    def _get_buckets(self, in_items):
+        """depth x len(in_items) table columns of the items"""
+        hashes = np.fromiter(imap(hash, in_items), dtype=np.int64, count=len(in_items)) % MERSENNE_PRIME
+        return (self.hash_a[:, np.newaxis] * hashes + self.hash_b[:, np.newaxis]) % MERSENNE_PRIME % self.width
+
+    def _estimate(self, in_buckets):
+        return np.min(self.table[np.arange(self.table.shape[0])[:, np.newaxis], in_buckets], axis=0).tolist()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        items, self.buffer = self.buffer, []
+        buckets = self._get_buckets(items)
+        for row, row_buckets in izip(self.table, buckets):
+            row += np.bincount(row_buckets, minlength=self.width)
+        # estimates only grow, the latest one of a repeated item wins
+        self.candidates.update(izip(items, self._estimate(buckets)))
+        if 2 * self.capacity < len(self.candidates):
+            self._prune()
+
+    def _prune(self):
+        self.candidates = dict(heapq.nlargest(self.capacity, self.candidates.iteritems(), key=itemgetter(1)))
+
+    def iteritems(self):
+        self._flush()
+        return self.candidates.iteritems()
+
+    def __len__(self):
+        self._flush()
+        return len(self.candidates)
+
+
+def make_counter(in_counter_type, in_capacity):
+    if in_counter_type == 'exact':
+        return Counter()
+    elif in_counter_type == 'space_saving':
+        return SpaceSavingCounter(in_capacity)
+    elif in_counter_type == 'count_min':
+        return CountMinSketchCounter(in_capacity)
+    raise NotImplementedError
+
+
+def merge_counts(in_counts, in_other):
+    if isinstance(in_counts, Counter):
+        in_counts.update(in_other)
+    else:
+        in_counts.merge(in_other)
+    return in_counts
+
+
+def count_dataset_file(in_args):
+    """Token and tag counts of a dataset file, the tags are few and always counted exactly"""
+    dataset_file, config, counter_type, capacity = in_args
+    return count_dataset_rows(iterate_dataset_file(dataset_file),
+                              config,
+                              token_counts=make_counter(counter_type, capacity))
+
+
+def count_dataset_files(in_dataset_files, in_config, processes_number=cpu_count(), counter_type='exact', capacity=None):
+    """Token and tag counts of the dataset files (e.g. the shards of pos_tag_dataset.py), counted a file
+    per worker and merged in the file order. capacity: tokens kept by the bounded counters.
+    The counts don't depend on processes_number, the order of the equally frequent tokens may"""
+    if capacity is None:
+        capacity = DEFAULT_CAPACITY_FACTOR * in_config['max_vocabulary_size']
+    tasks = [(dataset_file, in_config, counter_type, capacity) for dataset_file in in_dataset_files]
+    if processes_number < 2 or len(tasks) < 2:
+        file_counts = imap(count_dataset_file, tasks)
+        pool = None
+    else:
+        pool = Pool(min(processes_number, len(tasks)))
+        file_counts = pool.imap(count_dataset_file, tasks)
+    try:
+        token_counts, label_counts = next(file_counts)
+        for file_token_counts, file_label_counts in file_counts:
+            merge_counts(token_counts, file_token_counts)
+            label_counts.update(file_label_counts)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return token_counts, label_counts
+
+
+def build_vocabularies(in_dataset_files, in_config, processes_number=cpu_count(), counter_type='exact', capacity=None):
+    token_counts, label_counts = count_dataset_files(in_dataset_files,
+                                                     in_config,
+                                                     processes_number=processes_number,
+                                                     counter_type=counter_type,
+                                                     capacity=capacity)
+    vocab, _ = make_vocabulary_from_counts(token_counts, in_config['max_vocabulary_size'])
+    label_vocab, _ = make_vocabulary_from_counts(label_counts, in_config['max_vocabulary_size'], special_tokens=[])
+    return vocab, label_vocab
+
+
+def load_vocabularies(in_folder):
+    """The vocab.json and label_vocab.json saved by main()"""
+    with open(os.path.join(in_folder, VOCABULARY_NAME)) as vocab_in:
+        vocab = Vocabulary(json.load(vocab_in))
+    with open(os.path.join(in_folder, LABEL_VOCABULARY_NAME)) as label_vocab_in:
+        label_vocab = Vocabulary(json.load(label_vocab_in))
+    return vocab, label_vocab
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Build the token and tag vocabularies of a dataset in a single pass')
+    parser.add_argument('datasets', nargs='+', help='dataset files, e.g. the .jsonl shards, counted in parallel')
+    parser.add_argument('result_folder', help='where to save vocab.json and label_vocab.json (see train.py)')
+    parser.add_argument('--config', default=DEFAULT_CONFIG_FILE)
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='counting processes')
+    parser.add_argument('--counter',
+                        default='exact',
+                        help='[{}], the last two count in bounded memory'.format('/'.join(COUNTER_TYPES)))
+    parser.add_argument('--capacity',
+                        type=int,
+                        default=None,
+                        help='tokens kept by the bounded counters'
+                             ' ({} * max_vocabulary_size by default)'.format(DEFAULT_CAPACITY_FACTOR))
+
+    return parser
+
+
+def main(in_dataset_files, in_result_folder, in_config, processes_number=cpu_count(), counter_type='exact', capacity=None):
+    vocab, label_vocab = build_vocabularies(in_dataset_files,
+                                            in_config,
+                                            processes_number=processes_number,
+                                            counter_type=counter_type,
+                                            capacity=capacity)
+    if not os.path.exists(in_result_folder):
+        os.makedirs(in_result_folder)
+    with open(os.path.join(in_result_folder, VOCABULARY_NAME), 'w') as vocab_out:
+        json.dump(vocab, vocab_out)
+    with open(os.path.join(in_result_folder, LABEL_VOCABULARY_NAME), 'w') as label_vocab_out:
+        json.dump(label_vocab, label_vocab_out)
+    print '{} tokens, {} tags'.format(len(vocab), len(label_vocab))
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    main(args.datasets,
+         args.result_folder,
+         read_config(args.config),
+         processes_number=args.processes,
+         counter_type=args.counter,
+         capacity=args.capacity)
@@ -6,6 +6,10 @@ DEFAULT_CONFIG_FILE = os.path.join(THIS_FILE_DIR, 'config.json')
 
 
 def read_config(in_filename=DEFAULT_CONFIG_FILE):
+    """model_type: 'windowed' (a context window per token) or 'sequence' (an LSTM over the whole utterance).
+    batch_size counts the windowed model's tokens and the sequence model's utterances; the sequence loss
+    is averaged per real token and scaled by batch_size (see get_loss_function()),
+    so that lr and the dev losses mean the same for both model types"""
     with open(in_filename) as config_in:
         config = json.load(config_in)
     return config
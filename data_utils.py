@@ -1,15 +1,55 @@
+import heapq
 import string
-from collections import defaultdict, deque
+from collections import Counter, deque
 from operator import itemgetter
 import logging
-from itertools import chain
+from itertools import chain, imap, izip, repeat
 
-import tensorflow as tf
+import numpy as np
 
 PAD_ID = 0
 UNK_ID = 1
 PAD = '_PAD'
 UNK = '_UNK'
+POS_SEPARATOR = '_'
+
+
+class PairIndex(dict):
+    """(word, pos) -> id of the Vocabulary's '<word>_<pos>' tokens, split at their last separator.
+    The pairs missing from it, e.g. with a POS tag containing the separator, are looked up as strings"""
+    def __init__(self, in_vocab):
+        # special tokens like _PAD aren't (word, pos) pairs
+        super(PairIndex, self).__init__((tuple(token.rsplit(POS_SEPARATOR, 1)), token_id)
+                                        for token, token_id in in_vocab.iteritems()
+                                        if 0 < token.rfind(POS_SEPARATOR))
+        self.vocab = in_vocab
+
+    def __missing__(self, in_pair):
+        return self.vocab.get('{}{}{}'.format(in_pair[0], POS_SEPARATOR, in_pair[1]), UNK_ID)
+
+
+class Vocabulary(dict):
+    """token -> id mapping, saved to vocab.json as it is. Whole token sequences are looked up in one call,
+    and the use_pos_tags tokens (see augment_utterance()) by their (word, pos) pairs, without building
+    the strings. The pairs are indexed on the first vectorize_pairs() call, the mapping shouldn't change after it"""
+    def __init__(self, *args, **kwargs):
+        super(Vocabulary, self).__init__(*args, **kwargs)
+        self.pair_index = None
+
+    def vectorize(self, in_tokens, count=-1):
+        """int32 ids of the tokens, UNK_ID for the unknown ones"""
+        return np.fromiter(imap(self.get, in_tokens, repeat(UNK_ID)), dtype=np.int32, count=count)
+
+    def vectorize_pairs(self, in_words, in_pos, count=-1):
+        """int32 ids of the '<word>_<pos>' tokens, UNK_ID for the unknown ones"""
+        if self.pair_index is None:
+            self.pair_index = PairIndex(self)
+        return np.fromiter(imap(self.pair_index.__getitem__, izip(in_words, in_pos)), dtype=np.int32, count=count)
+
+
+def as_vocabulary(in_vocab):
+    """Vocabulary of a plain dict (e.g. a json-loaded one)"""
+    return in_vocab if isinstance(in_vocab, Vocabulary) else Vocabulary(in_vocab)
 
 
 def make_char_vocabulary():
@@ -19,27 +59,56 @@ def make_char_vocabulary():
     return vocab
 
 
+def count_ngrams(in_lines, ngram_sizes=(1,), counts=None):
+    """Counts of the space-joined n-grams of the token lines in a single pass, into counts if given
+    (a Counter or a bounded counter from build_vocabulary.py)"""
+    counts = Counter() if counts is None else counts
+    for line in in_lines:
+        for size in ngram_sizes:
+            if size == 1:
+                counts.update(line)
+            else:
+                counts.update(imap(' '.join, izip(*[line[offset:] for offset in xrange(size)])))
+    return counts
+
+
+def count_dataset_rows(in_rows, in_config, token_counts=None, label_counts=None):
+    """Token (see augment_utterance()) and tag counts of the (utterance, pos, tags) rows in a single pass"""
+    token_counts = Counter() if token_counts is None else token_counts
+    label_counts = Counter() if label_counts is None else label_counts
+    for utterance, pos, tags in in_rows:
+        token_counts.update(augment_utterance(utterance, pos, in_config))
+        label_counts.update(tags)
+    return token_counts, label_counts
+
+
+def make_vocabulary_from_counts(in_counts,
+                                max_vocabulary_size,
+                                special_tokens=(PAD, UNK),
+                                frequency_threshold=3):
+    """The special tokens and the most frequent counted ones. Only the top max_vocabulary_size are
+    picked (by a heap), in the same order as sorting all the counts would give"""
+    frequent_number = sum(1 for token, count in in_counts.iteritems() if frequency_threshold < count)
+    logging.info('{} tokens ({}% of the vocabulary) were filtered due to the frequency threshold'
+                 .format(len(in_counts) - frequent_number, 100.0 * frequent_number / float(len(in_counts))))
+    top = heapq.nlargest(max(max_vocabulary_size - len(special_tokens), 0),
+                         ((token, count) for token, count in in_counts.iteritems() if frequency_threshold < count),
+                         key=itemgetter(1))
+    rev_vocab = (list(special_tokens) + map(itemgetter(0), top))[:max_vocabulary_size]
+    vocab = Vocabulary((word, idx) for idx, word in enumerate(rev_vocab))
+    return vocab, rev_vocab
+
+
 def make_vocabulary(in_lines,
                     max_vocabulary_size,
                     special_tokens=(PAD, UNK),
                     frequency_threshold=3,
-                    ngram_sizes=(1,)):
-    freqdict = defaultdict(lambda: 0)
-
-    for line in in_lines:
-        ngram_windows = [deque([], maxlen=size) for size in ngram_sizes]
-        for token in line:
-            for window in ngram_windows:
-                window.append(token)
-                if len(window) == window.maxlen:
-                    freqdict[' '.join(window)] += 1
-    vocab = sorted(freqdict.items(), key=itemgetter(1), reverse=True)
-    vocab = filter(lambda x: frequency_threshold < x[1], vocab)
-    logging.info('{} tokens ({}% of the vocabulary) were filtered due to the frequency threshold'
-                 .format(len(freqdict) - len(vocab), 100.0 * len(vocab) / float(len(freqdict))))
-    rev_vocab = (list(special_tokens) + map(itemgetter(0), vocab))[:max_vocabulary_size]
-    vocab = {word: idx for idx, word in enumerate(rev_vocab)}
-    return vocab, rev_vocab
+                    ngram_sizes=(1,),
+                    counts=None):
+    return make_vocabulary_from_counts(count_ngrams(in_lines, ngram_sizes=ngram_sizes, counts=counts),
+                                       max_vocabulary_size,
+                                       special_tokens=special_tokens,
+                                       frequency_threshold=frequency_threshold)
 
 
 def vectorize_sequences(in_sequences, in_vocab):
@@ -49,11 +118,22 @@ def vectorize_sequences(in_sequences, in_vocab):
     return sequences_vectorized
 
 
-def pad_sequences(in_sequences, in_max_input_length, value=PAD_ID):
-    return tf.keras.preprocessing.sequence.pad_sequences(in_sequences,
-                                                         value=value,
-                                                         maxlen=in_max_input_length,
-                                                         padding='pre')
+def pad_sequences(in_sequences, in_max_input_length, value=PAD_ID, padding='pre'):
+    """keras' pad_sequences() in NumPy (so that the inference code doesn't need TensorFlow):
+    sequences longer than in_max_input_length (the longest sequence's length if None) keep their last tokens"""
+    max_input_length = in_max_input_length
+    if max_input_length is None:
+        max_input_length = max([len(sequence) for sequence in in_sequences] or [0])
+    result = np.full((len(in_sequences), max_input_length), value, dtype=np.int32)
+    for sequence_idx, sequence in enumerate(in_sequences):
+        sequence = sequence[len(sequence) - max_input_length:] if max_input_length < len(sequence) else sequence
+        if not len(sequence):
+            continue
+        if padding == 'pre':
+            result[sequence_idx, -len(sequence):] = sequence
+        else:
+            result[sequence_idx, :len(sequence)] = sequence
+    return result
 
 
 def create_contexts(in_tokens, in_max_input_length):
@@ -65,36 +145,149 @@ def create_contexts(in_tokens, in_max_input_length):
     return contexts
 
 
+def augment_utterance(in_tokens, in_pos, in_config):
+    if in_config['use_pos_tags']:
+        return ['{}_{}'.format(token, pos) for token, pos in zip(in_tokens, in_pos)]
+    return in_tokens
+
+
+def get_utterance_lengths(in_utterances):
+    return np.fromiter(imap(len, in_utterances), dtype=np.int64, count=len(in_utterances))
+
+
+def vectorize_rows(in_utterances, in_pos, in_vocab, in_config):
+    """Flat int32 ids of the augment_utterance() tokens of all the utterances (looked up without building them),
+    and the utterance lengths"""
+    lengths = get_utterance_lengths(in_utterances)
+    words = chain.from_iterable(in_utterances)
+    if in_config['use_pos_tags']:
+        token_ids = as_vocabulary(in_vocab).vectorize_pairs(words, chain.from_iterable(in_pos), count=np.sum(lengths))
+    else:
+        token_ids = as_vocabulary(in_vocab).vectorize(words, count=np.sum(lengths))
+    return token_ids, lengths
+
+
+def make_post_padded_input(in_token_ids, in_lengths, value=PAD_ID):
+    """One post-padded row per utterance from the flat token ids"""
+    max_length = np.max(in_lengths) if in_lengths.shape[0] else 0
+    result = np.full((in_lengths.shape[0], max_length), value, dtype=np.int32)
+    result[np.arange(max_length)[np.newaxis, :] < in_lengths[:, np.newaxis]] = in_token_ids
+    return result
+
+
+def make_model_input(in_token_ids, in_lengths, in_config):
+    """Model input (without labels) from the flat token ids of the utterances, see vectorize_rows()"""
+    if in_config.get('model_type', 'windowed') == 'sequence':
+        return make_post_padded_input(in_token_ids, in_lengths), in_lengths.astype(np.int32)
+    offsets = np.zeros(in_lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(in_lengths, out=offsets[1:])
+    return create_context_windows(in_token_ids, offsets, in_config['max_input_length'])
+
+
+def create_context_windows(in_token_ids, in_offsets, in_max_input_length, value=PAD_ID):
+    """The pre-padded contexts of create_contexts() + pad_sequences() as a [tokens number, in_max_input_length]
+    int32 matrix, computed over the flat token ids of all the utterances at once.
+    Utterance i is in_token_ids[in_offsets[i]: in_offsets[i + 1]]"""
+    token_ids = np.asarray(in_token_ids, dtype=np.int32)
+    offsets = np.asarray(in_offsets)
+    positions_in_utterance = np.arange(token_ids.shape[0]) - np.repeat(offsets[:-1], np.diff(offsets))
+    token_ids_padded = np.concatenate([np.full(in_max_input_length - 1, value, dtype=np.int32), token_ids])
+    # row i is a view of token_ids_padded[i: i + in_max_input_length], i.e. the window ending at token i
+    windows = np.lib.stride_tricks.as_strided(token_ids_padded,
+                                              shape=(token_ids.shape[0], in_max_input_length),
+                                              strides=(token_ids_padded.strides[0], token_ids_padded.strides[0]))
+    # masking out the tokens of previous utterances
+    is_in_utterance = (np.arange(in_max_input_length)[np.newaxis, :]
+                       >= (in_max_input_length - 1 - positions_in_utterance)[:, np.newaxis])
+    return np.where(is_in_utterance, windows, value).astype(np.int32)
+
+
+def vectorize_utterances(in_utterances, in_vocab, in_config):
+    """Model input (without labels) for the utterances of augment_utterance() tokens"""
+    lengths = get_utterance_lengths(in_utterances)
+    token_ids = as_vocabulary(in_vocab).vectorize(chain.from_iterable(in_utterances), count=np.sum(lengths))
+    return make_model_input(token_ids, lengths, in_config)
+
+
+def make_windowed_input(in_utterances, in_vocab, in_config):
+    return vectorize_utterances(in_utterances, in_vocab, dict(in_config, model_type='windowed'))
+
+
+def make_sequence_input(in_utterances, in_vocab):
+    return vectorize_utterances(in_utterances, in_vocab, {'model_type': 'sequence'})
+
+
 def make_multitask_dataset(in_dataset, in_vocab, in_label_vocab, in_config):
-    utterances, contexts = [], []
-    for idx, row in in_dataset.iterrows():
-        if in_config['use_pos_tags']:
-            utterance = ['{}_{}'.format(token, pos)
-                         for token, pos in zip(row['utterance'], row['pos'])]
-        else:
-            utterance = row['utterance']
-        utterances.append(utterance)
-        current_contexts = create_contexts(utterance,
-                                           in_config['max_input_length'])
-        contexts += current_contexts
-    tokens_vectorized = vectorize_sequences(contexts, in_vocab)
-    tokens_padded = pad_sequences(tokens_vectorized, in_config['max_input_length'])
+    token_ids, lengths = vectorize_rows(in_dataset['utterance'], in_dataset.get('pos'), in_vocab, in_config)
+    tokens_padded = make_model_input(token_ids, lengths, dict(in_config, model_type='windowed'))
+
+    ys_for_tasks = make_task_labels(in_dataset['tags'], token_ids, lengths, in_label_vocab, in_config)
+    return tokens_padded, ys_for_tasks
+
+
+def make_sequence_multitask_dataset(in_dataset,
+                                    in_vocab,
+                                    in_label_vocab,
+                                    in_config,
+                                    bucket_by_length=False):
+    """One post-padded row per utterance (plus the utterance lengths) for the sequence-level model.
+    The labels are per token, in the same order as in make_multitask_dataset().
+    With bucket_by_length, utterances are sorted by length so that batches need minimal padding"""
+    if bucket_by_length:
+        utterance_lengths = in_dataset['utterance'].apply(len).values
+        in_dataset = in_dataset.iloc[np.argsort(utterance_lengths, kind='mergesort')]
+    token_ids, lengths = vectorize_rows(in_dataset['utterance'], in_dataset.get('pos'), in_vocab, in_config)
+    X = make_model_input(token_ids, lengths, dict(in_config, model_type='sequence'))
+
+    ys_for_tasks = make_task_labels(in_dataset['tags'], token_ids, lengths, in_label_vocab, in_config)
+    return X, ys_for_tasks
+
 
+def vectorize_dataset(in_dataset, in_vocab, in_label_vocab, in_config, bucket_by_length=False):
+    if in_config.get('model_type', 'windowed') == 'sequence':
+        return make_sequence_multitask_dataset(in_dataset,
+                                               in_vocab,
+                                               in_label_vocab,
+                                               in_config,
+                                               bucket_by_length=bucket_by_length)
+    return make_multitask_dataset(in_dataset, in_vocab, in_label_vocab, in_config)
+
+
+def iterate_dataset_file(in_dataset_file, chunk_size=1024):
+    """(utterance, pos, tags) rows of a dataset file. JSON lines files (*.jsonl, one utterance per line)
+    are read chunk_size rows at a time, other files are read by pd.read_json() as a whole"""
+    # pandas is only needed for reading the files, the inference backends don't import it
+    import pandas as pd
+
+    if in_dataset_file.endswith('.jsonl'):
+        chunks = pd.read_json(in_dataset_file, lines=True, chunksize=chunk_size)
+    else:
+        chunks = [pd.read_json(in_dataset_file)]
+    for chunk in chunks:
+        for row in iterate_dataset_rows(chunk):
+            yield row
+
+
+def iterate_dataset_rows(in_dataset):
+    pos = in_dataset['pos'] if 'pos' in in_dataset else [None] * in_dataset.shape[0]
+    return zip(in_dataset['utterance'], pos, in_dataset['tags'])
+
+
+def make_task_labels(in_tags, in_token_ids, in_lengths, in_label_vocab, in_config):
+    """Flat per-token labels of the tasks, in_token_ids and in_lengths being the vectorize_rows() output"""
     ys_for_tasks = []
     for task in in_config['tasks']:
         if task == 'tag':
-            labels = vectorize_sequences(in_dataset['tags'], in_label_vocab)
-            labels = list(chain(*labels))
-            y_i = tf.keras.utils.to_categorical(labels, num_classes=len(in_label_vocab))
+            y_i = as_vocabulary(in_label_vocab).vectorize(chain.from_iterable(in_tags), count=np.sum(in_lengths))
         elif task == 'lm':
-            label_sequences = [utterance[1:] + [PAD] for utterance in utterances]
-            labels = vectorize_sequences(label_sequences, in_vocab)
-            labels = list(chain(*labels))
-            y_i = tf.keras.utils.to_categorical(labels, num_classes=len(in_vocab))
+            # the next token of the utterance, PAD after the last one
+            y_i = np.empty_like(in_token_ids)
+            y_i[:-1] = in_token_ids[1:]
+            y_i[np.cumsum(in_lengths)[0 < in_lengths] - 1] = PAD_ID
         else:
             raise NotImplementedError
         ys_for_tasks.append(y_i)
-    return tokens_padded, ys_for_tasks
+    return ys_for_tasks
 
 
 def make_dataset(in_dataset, in_vocab, in_label_vocab, in_config):
@@ -114,7 +307,7 @@ def make_dataset(in_dataset, in_vocab, in_label_vocab, in_config):
     tokens_padded = pad_sequences(tokens_vectorized, in_config['max_input_length'])
 
     labels = vectorize_sequences([tags], in_label_vocab)
-    y = tf.keras.utils.to_categorical(labels[0], num_classes=len(in_label_vocab))
+    y = np.eye(len(in_label_vocab))[labels[0]]
     return tokens_padded, y
 
 
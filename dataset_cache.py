@@ -0,0 +1,97 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from data_utils import vectorize_dataset
+
+THIS_FILE_DIR = os.path.dirname(__file__)
+DEFAULT_CACHE_FOLDER = os.path.join(THIS_FILE_DIR, 'dataset_cache')
+CONFIG_FIELDS = ['use_pos_tags', 'max_input_length', 'tasks']
+
+
+def get_file_hash(in_file_name, block_size=1 << 20):
+    file_hash = hashlib.sha1()
+    with open(in_file_name, 'rb') as file_in:
+        for block in iter(lambda: file_in.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_cache_key(in_dataset_file, in_vocab, in_label_vocab, in_config, bucket_by_length=False):
+    key_hash = hashlib.sha1()
+    key_hash.update(get_file_hash(in_dataset_file))
+    key_hash.update(json.dumps(in_vocab, sort_keys=True))
+    key_hash.update(json.dumps(in_label_vocab, sort_keys=True))
+    key_hash.update(json.dumps([in_config[field] for field in CONFIG_FIELDS]
+                               + [in_config.get('model_type', 'windowed'), bucket_by_length]))
+    return key_hash.hexdigest()
+
+
+def save_vectorized_dataset(in_X, in_ys_for_tasks, in_folder):
+    """Each array is saved as a separate .npy file so that it can be memory-mapped on loading"""
+    if isinstance(in_X, tuple):
+        np.save(os.path.join(in_folder, 'X.npy'), in_X[0])
+        np.save(os.path.join(in_folder, 'lengths.npy'), in_X[1])
+    else:
+        np.save(os.path.join(in_folder, 'X.npy'), in_X)
+    for task_idx, y_i in enumerate(in_ys_for_tasks):
+        np.save(os.path.join(in_folder, 'y_{}.npy'.format(task_idx)), y_i)
+
+
+def load_vectorized_dataset(in_folder, in_tasks_number, mmap_mode='r'):
+    X = np.load(os.path.join(in_folder, 'X.npy'), mmap_mode=mmap_mode)
+    lengths_file = os.path.join(in_folder, 'lengths.npy')
+    if os.path.exists(lengths_file):
+        X = (X, np.load(lengths_file, mmap_mode=mmap_mode))
+    ys_for_tasks = [np.load(os.path.join(in_folder, 'y_{}.npy'.format(task_idx)), mmap_mode=mmap_mode)
+                    for task_idx in xrange(in_tasks_number)]
+    return X, ys_for_tasks
+
+
+def get_vectorized_dataset(in_dataset_file,
+                           in_vocab,
+                           in_label_vocab,
+                           in_config,
+                           cache_folder=DEFAULT_CACHE_FOLDER,
+                           bucket_by_length=False,
+                           dataset=None):
+    """vectorize_dataset() of a dataset file through an on-disk cache of memory-mapped .npy arrays,
+    keyed by the file contents, the vocabularies and the config fields the vectorisation depends on.
+    dataset: the file's already loaded DataFrame, if any, to be used on a cache miss"""
+    if not cache_folder:
+        if dataset is None:
+            dataset = pd.read_json(in_dataset_file)
+        return vectorize_dataset(dataset, in_vocab, in_label_vocab, in_config, bucket_by_length=bucket_by_length)
+    cache_key = get_cache_key(in_dataset_file, in_vocab, in_label_vocab, in_config, bucket_by_length)
+    entry_folder = os.path.join(cache_folder, cache_key)
+    if not os.path.exists(entry_folder):
+        if not os.path.exists(cache_folder):
+            try:
+                os.makedirs(cache_folder)
+            except OSError:
+                pass
+        # concurrent runs (e.g. sweep trials) wait for the one vectorising the same dataset
+        with open(entry_folder + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(entry_folder):
+                if dataset is None:
+                    dataset = pd.read_json(in_dataset_file)
+                X, ys_for_tasks = vectorize_dataset(dataset,
+                                                    in_vocab,
+                                                    in_label_vocab,
+                                                    in_config,
+                                                    bucket_by_length=bucket_by_length)
+                # writing to a temporary folder first so that readers never see a partial entry
+                tmp_folder = tempfile.mkdtemp(dir=cache_folder)
+                save_vectorized_dataset(X, ys_for_tasks, tmp_folder)
+                try:
+                    os.rename(tmp_folder, entry_folder)
+                except OSError:
+                    shutil.rmtree(tmp_folder)
+    return load_vectorized_dataset(entry_folder, len(in_config['tasks']))
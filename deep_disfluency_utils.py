@@ -4,10 +4,6 @@ import sys
 THIS_FILE_DIR = os.path.dirname(__file__)
 sys.path.append(os.path.join(THIS_FILE_DIR, 'deep_disfluency'))
 
-from deep_disfluency.feature_extraction.feature_utils import load_data_from_disfluency_corpus_file
-from deep_disfluency.evaluation.disf_evaluation import get_tag_data_from_corpus_file
-from deep_disfluency.utils.tools import convert_from_eval_tags_to_inc_disfluency_tags
-
 
 def get_tag_mapping(in_tag_map, mode='deep_disfluency'):
     if mode == 'deep_disfluency':
@@ -20,6 +16,11 @@ def get_tag_mapping(in_tag_map, mode='deep_disfluency'):
 
 
 def load_dataset(in_filename, convert_to_dnn_format=True):
+    # deep_disfluency is only loaded for reading the corpus, get_tag_mapping() doesn't need it
+    from deep_disfluency.feature_extraction.feature_utils import load_data_from_disfluency_corpus_file
+    from deep_disfluency.evaluation.disf_evaluation import get_tag_data_from_corpus_file
+    from deep_disfluency.utils.tools import convert_from_eval_tags_to_inc_disfluency_tags
+
     if 'timings' in in_filename:
         dialogues = []
         IDs, timings, words, pos_tags, labels = get_tag_data_from_corpus_file(in_filename)
@@ -1,43 +1,57 @@
+import os
+import sys
 from argparse import ArgumentParser
 
-import tensorflow as tf
-
-from dialogue_denoiser_lstm import load, filter_line
+from config import read_config
+from numpy_model import is_numpy_model, NumpyDenoiser, CONFIG_NAME
+from session_utils import configure_session_arguments, get_session_settings, set_cpu_affinity
 
 
 def configure_argument_parser():
     parser = ArgumentParser(description='Interactive LSTM dialogue filter')
-    parser.add_argument('model_folder')
+    parser.add_argument('model_folder', help='a trained model, or its frozen_model/numpy_model export')
+    parser.add_argument('--batch', action='store_true', default=False,
+                        help='read all the lines from stdin and tag them in batches')
+    configure_session_arguments(parser)
 
     return parser
 
 
-def run(in_model_folder):
-    with tf.Session() as sess:
-        model, actual_config, vocab, char_vocab, label_vocab = load(in_model_folder,
-                                                                    sess)
-        rev_vocab = {word_id: word
-                     for word, word_id in vocab.iteritems()}
-        rev_label_vocab = {label_id: label
-                           for label, label_id in label_vocab.iteritems()}
-        print 'Done loading'
-        try:
+def filter_stdin(in_denoiser, in_batch_mode):
+    print 'Done loading'
+    if in_batch_mode:
+        lines = [line.strip() for line in sys.stdin]
+        for result in in_denoiser.filter_lines(lines):
+            print result
+        return
+    try:
+        line = raw_input().strip()
+        while line:
+            print in_denoiser.filter_lines([line])[0]
             line = raw_input().strip()
-            while line:
-                print filter_line(line,
-                                  model,
-                                  [(vocab, label_vocab, rev_label_vocab),
-                                   (vocab, vocab, rev_vocab)],
-                                  actual_config,
-                                  sess)
-                line = raw_input().strip()
-        except EOFError as e:
-            pass
+    except EOFError as e:
+        pass
+
+
+def run(in_model_folder, in_batch_mode, session_settings=None):
+    if session_settings is None:
+        session_settings = get_session_settings(read_config(os.path.join(in_model_folder, CONFIG_NAME)))
+    if is_numpy_model(in_model_folder):
+        if session_settings.get('cpu_affinity'):
+            set_cpu_affinity(session_settings['cpu_affinity'])
+        filter_stdin(NumpyDenoiser(in_model_folder), in_batch_mode)
+        return
+    # TensorFlow is only imported for the TF models
+    from denoiser import Denoiser
+    from session_utils import create_session
+
+    with create_session(session_settings) as sess:
+        filter_stdin(Denoiser(in_model_folder, sess), in_batch_mode)
 
 
 if __name__ == '__main__':
     parser = configure_argument_parser()
     args = parser.parse_args()
 
-    run(args.model_folder)
-
+    config = read_config(os.path.join(args.model_folder, CONFIG_NAME))
+    run(args.model_folder, args.batch, session_settings=get_session_settings(config, vars(args)))
@@ -0,0 +1,47 @@
+import numpy as np
+
+from data_utils import make_model_input, vectorize_rows
+from dialogue_denoiser_lstm import load, create_prediction_ops
+from frozen_model import is_frozen_model, load_frozen_model
+from pos_tag_dataset import pos_tag_batch
+from training_utils import batch_generator
+
+
+class Denoiser(object):
+    """Batched inference: the model is loaded and the prediction ops are built once,
+    and all the contexts of a list of utterances are tagged in large batches.
+    in_model_folder can also be a frozen_model export"""
+    def __init__(self, in_model_folder, in_session, batch_size=1024):
+        self.session = in_session
+        self.batch_size = batch_size
+        load_model = load_frozen_model if is_frozen_model(in_model_folder) else load
+        self.model, self.config, self.vocab, self.char_vocab, self.label_vocab = load_model(in_model_folder,
+                                                                                            in_session)
+        self.rev_label_vocab = {label_id: label
+                                for label, label_id in self.label_vocab.iteritems()}
+        self.y_pred_op = create_prediction_ops(self.model)['y_pred'][0]
+
+    def tag(self, in_utterances, in_pos=None):
+        """Disfluency tags for every token of every utterance (a list of token lists).
+        POS tags are computed if the model needs them and in_pos is not given"""
+        if not sum(map(len, in_utterances)):
+            return [[] for _ in in_utterances]
+        if self.config['use_pos_tags'] and in_pos is None:
+            in_pos = pos_tag_batch(in_utterances)
+        token_ids, lengths = vectorize_rows(in_utterances, in_pos, self.vocab, self.config)
+        X = make_model_input(token_ids, lengths, self.config)
+        X_placeholder = self.model[0]
+        y_pred = [self.session.run(self.y_pred_op, feed_dict={X_placeholder: batch_x})
+                  for batch_x, _ in batch_generator(X, [], self.batch_size, verbose=False)]
+        y_pred = np.concatenate(y_pred)
+
+        tags, token_idx = [], 0
+        for utterance in in_utterances:
+            tags.append([self.rev_label_vocab[label_id]
+                         for label_id in y_pred[token_idx: token_idx + len(utterance)]])
+            token_idx += len(utterance)
+        return tags
+
+    def filter_lines(self, in_lines):
+        utterances = [unicode(line.lower()).split() for line in in_lines]
+        return [' '.join(tags) for tags in self.tag(utterances)]
@@ -2,30 +2,23 @@ import json
 import random
 import os
 import sys
+import time
 from copy import deepcopy
+from itertools import imap
 
-import sklearn as sk
 import tensorflow as tf
-from tensorflow.contrib import rnn
 import numpy as np
-import pandas as pd
 
-from data_utils import make_multitask_dataset
+from data_utils import make_model_input, make_task_labels, vectorize_dataset, vectorize_rows, Vocabulary
+from deep_disfluency_utils import get_tag_mapping
 from pos_tag_dataset import pos_tag
-from training_utils import get_loss_function, batch_generator
+from training_utils import get_loss_function, batch_generator, prefetch_generator, prepare_batch
 
 THIS_FILE_DIR = os.path.dirname(__file__)
+# the deep_disfluency evaluation stack, sklearn and pandas are imported by the functions using them:
+# training and tagging don't need them
 sys.path.append(os.path.join(THIS_FILE_DIR, 'deep_disfluency'))
 
-from deep_disfluency.utils.tools import (convert_from_eval_tags_to_inc_disfluency_tags,
-                                         convert_from_inc_disfluency_tags_to_eval_tags)
-from deep_disfluency.utils.tools import convert_from_inc_disfluency_tags_to_eval_tags
-from deep_disfluency.evaluation.disf_evaluation import incremental_output_disfluency_eval_from_file
-from deep_disfluency.evaluation.disf_evaluation import final_output_disfluency_eval_from_file
-from deep_disfluency.evaluation.eval_utils import get_tag_data_from_corpus_file
-from deep_disfluency.evaluation.eval_utils import rename_all_repairs_in_line_with_index
-from deep_disfluency_utils import get_tag_mapping
-
 random.seed(273)
 np.random.seed(273)
 tf.set_random_seed(273)
@@ -57,23 +50,34 @@ def train(in_model,
           session,
           class_weights=None,
           task_weights=None,
+          train_batches=None,
+          epoch_callback=None,
           **kwargs):
-    X_train, y_train_for_tasks = train_data
+    """train_batches: optional function returning a new iterator over the (X, ys) training batches
+    for every epoch (e.g. over stream_batch_generator()), to be used instead of batching train_data.
+    epoch_callback: optional function called with the epoch number and its dev results,
+    training stops if it returns False.
+    Returns the dev results of the best epoch"""
+    X_train, y_train_for_tasks = train_data if train_data is not None else (None, None)
 
     tag_mapping = get_tag_mapping(in_task_vocabs[0][1])
 
-    X, ys_for_tasks, logits_for_tasks = in_model
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
 
     if class_weights is None:
-        class_weights = [np.ones(y_train_i.shape[1]) for y_train_i in y_train_for_tasks]
+        class_weights = [np.ones(logits_i.shape[1].value) for logits_i in logits_for_tasks]
     if task_weights is None:
-        task_weights = np.ones(len(y_train_for_tasks))
+        task_weights = np.ones(len(logits_for_tasks))
     # Define loss and optimizer
     loss_op = get_loss_function(logits_for_tasks,
                                 ys_for_tasks,
                                 class_weights,
                                 l2_coef=config['l2_coef'],
-                                task_weights=task_weights)
+                                task_weights=task_weights,
+                                task_losses=get_task_losses(config),
+                                num_sampled=config.get('lm_num_sampled', 512),
+                                hidden=hidden,
+                                lengths=get_input_lengths(X))
 
     starting_lr = config['lr']
     lr_decay = config['lr_decay']
@@ -87,6 +91,7 @@ def train(in_model,
     train_op = optimizer.minimize(loss_op, global_step)
 
     saver = tf.train.Saver(tf.global_variables())
+    model_ops = create_evaluation_ops(in_model, class_weights, task_weights, config)
 
     _, dev_eval = evaluate(in_model,
                            dev_data,
@@ -94,31 +99,35 @@ def train(in_model,
                            class_weights,
                            task_weights,
                            config,
-                           session)
+                           session,
+                           model_ops=model_ops)
     best_dev_f1_rm = dev_eval['f1_rm']
+    best_dev_eval = dev_eval
     epochs_without_improvement = 0
     for epoch_counter in xrange(in_epochs_number):
-        batch_gen = batch_generator(X_train,
-                                    y_train_for_tasks,
-                                    config['batch_size'])
-        train_batch_losses = []
-        for batch_x, batch_y in batch_gen:
-            _, train_batch_loss = session.run([train_op, loss_op],
-                                              feed_dict={X: batch_x, ys_for_tasks: batch_y})
-            train_batch_losses.append(train_batch_loss)
+        if train_batches is not None:
+            batch_gen = train_batches()
+        else:
+            batch_gen = batch_generator(X_train,
+                                        y_train_for_tasks,
+                                        config['batch_size'],
+                                        shuffle=config.get('shuffle_batches', False))
+        train_batch_losses, steps_per_sec = train_epoch(in_model, batch_gen, train_op, loss_op, config, session)
         _, dev_eval = evaluate(in_model,
                                dev_data,
                                tag_mapping,
                                class_weights,
                                task_weights,
                                config,
-                               session)
+                               session,
+                               model_ops=model_ops)
         print 'Epoch {} out of {} results'.format(epoch_counter, in_epochs_number)
-        print 'train loss: {:.3f}'.format(np.mean(train_batch_losses))
+        print 'train loss: {:.3f} ({:.1f} steps/sec)'.format(np.mean(train_batch_losses), steps_per_sec)
         print '; '.join(['dev {}: {:.3f}'.format(key, value)
                          for key, value in dev_eval.iteritems()]) + ' @lr={}'.format(session.run(learning_rate))
         if best_dev_f1_rm < dev_eval['f1_rm']:
             best_dev_f1_rm = dev_eval['f1_rm']
+            best_dev_eval = dev_eval
             saver.save(session, os.path.join(in_model_folder, MODEL_NAME))
             print 'New best loss. Saving checkpoint'
             epochs_without_improvement = 0
@@ -127,8 +136,12 @@ def train(in_model,
         if config['early_stopping_threshold'] < epochs_without_improvement:
             print 'Early stopping after {} epochs'.format(epoch_counter)
             break
+        if epoch_callback is not None and epoch_callback(epoch_counter, dev_eval) is False:
+            print 'Stopped after {} epochs'.format(epoch_counter)
+            break
 
     print 'Optimization Finished!'
+    return best_dev_eval
 
 
 def post_train_lm(in_model,
@@ -147,23 +160,27 @@ def post_train_lm(in_model,
 
     tag_mapping = get_tag_mapping(in_task_vocabs[0][1])
 
-    X, ys_for_tasks, logits_for_tasks = in_model
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
 
     for v in tf.trainable_variables():
-        v_initial = tf.Variable(v, name=v.name + '_initial', trainable=False)
+        v_initial = tf.Variable(v, name=v.name.partition(':')[0] + '_initial', trainable=False)
         session.run(v_initial.initializer)
 
     if class_weights is None:
-        class_weights = [np.ones(y_train_i.shape[1]) for y_train_i in y_train_for_tasks]
+        class_weights = [np.ones(logits_i.shape[1].value) for logits_i in logits_for_tasks]
     if task_weights is None:
-        task_weights = {'lm': 1.0, 'tag': 0.0}
+        task_weights = [{'lm': 1.0, 'tag': 0.0}[task] for task in config['tasks']]
     # Define loss and optimizer
     loss_op = get_loss_function(logits_for_tasks,
                                 ys_for_tasks,
                                 class_weights,
                                 l2_coef=config['l2_coef'],
                                 task_weights=task_weights,
-                                weight_trajectory_coef=0.99)
+                                weight_change_penalization_coef=0.99,
+                                task_losses=get_task_losses(config),
+                                num_sampled=config.get('lm_num_sampled', 512),
+                                hidden=hidden,
+                                lengths=get_input_lengths(X))
 
     starting_lr = config['lr']
     lr_decay = config['lr_decay']
@@ -177,6 +194,7 @@ def post_train_lm(in_model,
     train_op = optimizer.minimize(loss_op, global_step)
 
     saver = tf.train.Saver(tf.global_variables())
+    model_ops = create_evaluation_ops(in_model, class_weights, task_weights, config)
 
     _, dev_eval = evaluate(in_model,
                            dev_data,
@@ -184,27 +202,26 @@ def post_train_lm(in_model,
                            class_weights,
                            task_weights,
                            config,
-                           session)
+                           session,
+                           model_ops=model_ops)
     best_dev_f1_rm = dev_eval['f1_rm']
     epochs_without_improvement = 0
     for epoch_counter in xrange(in_epochs_number):
         batch_gen = batch_generator(X_train,
                                     y_train_for_tasks,
-                                    config['batch_size'])
-        train_batch_losses = []
-        for batch_x, batch_y in batch_gen:
-            _, train_batch_loss = session.run([train_op, loss_op],
-                                              feed_dict={X: batch_x, ys_for_tasks: batch_y})
-            train_batch_losses.append(train_batch_loss)
+                                    config['batch_size'],
+                                    shuffle=config.get('shuffle_batches', False))
+        train_batch_losses, steps_per_sec = train_epoch(in_model, batch_gen, train_op, loss_op, config, session)
         _, dev_eval = evaluate(in_model,
                                dev_data,
                                tag_mapping,
                                class_weights,
                                task_weights,
                                config,
-                               session)
+                               session,
+                               model_ops=model_ops)
         print 'Epoch {} out of {} results'.format(epoch_counter, in_epochs_number)
-        print 'train loss: {:.3f}'.format(np.mean(train_batch_losses))
+        print 'train loss: {:.3f} ({:.1f} steps/sec)'.format(np.mean(train_batch_losses), steps_per_sec)
         print '; '.join(['dev {}: {:.3f}'.format(key, value)
                          for key, value in dev_eval.iteritems()]) + ' @lr={}'.format(session.run(learning_rate))
         if best_dev_f1_rm < dev_eval['f1_rm']:
@@ -221,6 +238,58 @@ def post_train_lm(in_model,
     print 'Optimization Finished!'
 
 
+def train_epoch(in_model, in_batches, in_train_op, in_loss_op, config, session):
+    """One pass of the training op over the batches. With config['prefetch_batches'] set, the batches
+    are sliced and copied into memory on a background thread while the previous training steps run.
+    Returns the batch losses and the training steps/sec"""
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
+    prefetch_batches = config.get('prefetch_batches', 0)
+    if prefetch_batches:
+        in_batches = prefetch_generator(imap(prepare_batch, in_batches), buffer_size=prefetch_batches)
+    batch_losses = []
+    start = time.time()
+    for batch_x, batch_y in in_batches:
+        _, batch_loss = session.run([in_train_op, in_loss_op],
+                                    feed_dict={X: batch_x, ys_for_tasks: batch_y})
+        batch_losses.append(batch_loss)
+    return batch_losses, len(batch_losses) / (time.time() - start)
+
+
+def get_task_losses(in_config):
+    """Training losses for the tasks: the LM head may use a sampled approximation
+    ('sampled_softmax'/'nce'), evaluation always uses the full softmax"""
+    return [in_config.get('lm_loss', 'softmax') if task == 'lm' else 'softmax'
+            for task in in_config['tasks']]
+
+
+def get_input_lengths(in_X):
+    """The utterance lengths input of a sequence model, None for a windowed one"""
+    return in_X[1] if isinstance(in_X, tuple) else None
+
+
+def create_prediction_ops(in_model):
+    """Ops for predict(), to be built once per model and reused across calls"""
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
+    return {'y_pred': [tf.argmax(logits_i, 1, output_type=tf.int32) for logits_i in logits_for_tasks]}
+
+
+def create_evaluation_ops(in_model, in_class_weights, in_task_weights, in_config):
+    """Ops for evaluate() and predict(), to be built once per model and reused across calls"""
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
+    model_ops = create_prediction_ops(in_model)
+
+    # Evaluate model (with test logits, for dropout to be disabled)
+    model_ops['loss'] = get_loss_function(logits_for_tasks,
+                                          ys_for_tasks,
+                                          in_class_weights,
+                                          l2_coef=in_config['l2_coef'],
+                                          task_weights=in_task_weights,
+                                          lengths=get_input_lengths(X))
+    correct_pred = tf.equal(model_ops['y_pred'], ys_for_tasks)
+    model_ops['accuracy'] = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
+    return model_ops
+
+
 def evaluate(in_model,
              in_dataset,
              in_tag_map,
@@ -228,60 +297,58 @@ def evaluate(in_model,
              in_task_weights,
              in_config,
              in_session,
-             batch_size=32):
-    X_test, y_test_for_tasks = in_dataset
-    X, ys_for_tasks, logits_for_tasks = in_model
+             batch_size=32,
+             model_ops=None):
+    from sklearn.metrics import f1_score
 
-    # Evaluate model (with test logits, for dropout to be disabled)
-    loss_op = get_loss_function(logits_for_tasks,
-                                ys_for_tasks,
-                                in_class_weights,
-                                l2_coef=in_config['l2_coef'],
-                                task_weights=in_task_weights)
-    y_pred_op = [tf.argmax(logits_i, 1) for logits_i in logits_for_tasks]
-    y_true_op = [tf.argmax(y_i, 1) for y_i in ys_for_tasks]
+    X_test, y_test_for_tasks = in_dataset
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
 
-    correct_pred = tf.equal(y_pred_op, y_true_op)
-    accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
+    if model_ops is None:
+        model_ops = create_evaluation_ops(in_model, in_class_weights, in_task_weights, in_config)
+    y_pred_op, loss_op, accuracy = model_ops['y_pred'], model_ops['loss'], model_ops['accuracy']
 
     # Start training
     batch_gen = batch_generator(X_test, y_test_for_tasks, batch_size)
 
     batch_losses, batch_accuracies = [], []
-    y_pred_main_task = np.zeros(X_test.shape[0])
+    y_pred_main_task = []
     for batch_idx, (batch_x, batch_y) in enumerate(batch_gen):
         y_pred_batch, loss_batch, acc_batch = in_session.run([y_pred_op, loss_op, accuracy],
                                                               feed_dict={X: batch_x,
                                                                          ys_for_tasks: batch_y})
-        y_pred_main_task[batch_idx * batch_size: (batch_idx + 1) * batch_size] = y_pred_batch[0]
+        y_pred_main_task.append(y_pred_batch[0])
         batch_losses.append(loss_batch)
         batch_accuracies.append(acc_batch)
+    y_pred_main_task = np.concatenate(y_pred_main_task)
 
-    y_gold_main_task = np.argmax(y_test_for_tasks[0], -1)
+    y_gold_main_task = y_test_for_tasks[0]
     result_map = {'loss': np.mean(batch_losses), 'acc': np.mean(batch_accuracies)}
     for class_name, class_ids in in_tag_map.iteritems():
-        result_map['f1_' + class_name] = sk.metrics.f1_score(y_true=y_gold_main_task
-                                                             ,
-                                                             y_pred=y_pred_main_task,
-                                                             labels=class_ids,
-                                                             average='micro')
+        result_map['f1_' + class_name] = f1_score(y_true=y_gold_main_task,
+                                                  y_pred=y_pred_main_task,
+                                                  labels=class_ids,
+                                                  average='micro')
     return y_pred_main_task, result_map
 
 
-def predict(in_model, in_dataset, in_vocabs_for_tasks, in_session, batch_size=32):
+def predict(in_model, in_dataset, in_vocabs_for_tasks, in_session, batch_size=32, model_ops=None):
     X_test, y_test_for_tasks = in_dataset
-    X, ys_for_tasks, logits_for_tasks = in_model
+    X, ys_for_tasks, logits_for_tasks, hidden = in_model
 
-    y_pred_op = [tf.argmax(logits_i, 1) for logits_i in logits_for_tasks]
+    if model_ops is None:
+        model_ops = create_prediction_ops(in_model)
+    y_pred_op = model_ops['y_pred']
 
     # Start training
     batch_gen = batch_generator(X_test, y_test_for_tasks, batch_size)
 
-    y_pred_main_task = np.zeros(X_test.shape[0])
+    y_pred_main_task = []
     for batch_idx, (batch_x, batch_ys) in enumerate(batch_gen):
         y_pred_batch = in_session.run(y_pred_op,
                                        feed_dict={X: batch_x})
-        y_pred_main_task[batch_idx * batch_size: (batch_idx + 1) * batch_size] = y_pred_batch[0]
+        y_pred_main_task.append(y_pred_batch[0])
+    y_pred_main_task = np.concatenate(y_pred_main_task)
 
     rev_label_vocab_main_task = in_vocabs_for_tasks[0][2]
     predictions = map(rev_label_vocab_main_task.get, y_pred_main_task) 
@@ -327,6 +394,11 @@ def predict_increco_file(in_model,
     :param target_file_path: str, file path to output in the above format
     :param is_asr_results_file: bool, whether the input is increco style
     """
+    import pandas as pd
+    from deep_disfluency.utils.tools import (convert_from_eval_tags_to_inc_disfluency_tags,
+                                             convert_from_inc_disfluency_tags_to_eval_tags)
+    from deep_disfluency.evaluation.eval_utils import get_tag_data_from_corpus_file
+
     if target_file_path:
         target_file = open(target_file_path, "w")
     if 'timings' in source_file_path:
@@ -370,10 +442,10 @@ def predict_increco_file(in_model,
                                                                                    representation="disf1")
                                      for tags_i, words_i in zip(tags, utterances)],
                             'pos': pos})
-    X, ys_for_tasks = make_multitask_dataset(dataset,
-                                             vocabs_for_tasks[0][0],
-                                             vocabs_for_tasks[0][1],
-                                             in_config)
+    X, ys_for_tasks = vectorize_dataset(dataset,
+                                        vocabs_for_tasks[0][0],
+                                        vocabs_for_tasks[0][1],
+                                        in_config)
     predictions = predict(in_model,
                           (X, ys_for_tasks),
                           vocabs_for_tasks,
@@ -433,6 +505,11 @@ def eval_deep_disfluency(in_model,
                          in_config,
                          in_session,
                          verbose=True):
+    from deep_disfluency.evaluation.disf_evaluation import (incremental_output_disfluency_eval_from_file,
+                                                            final_output_disfluency_eval_from_file)
+    from deep_disfluency.evaluation.eval_utils import (get_tag_data_from_corpus_file,
+                                                       rename_all_repairs_in_line_with_index)
+
     increco_file = 'swbd_disf_heldout_data_output_increco.text'
     predict_increco_file(in_model,
                          in_vocabs_for_tasks,
@@ -497,14 +574,16 @@ def predict_babi_file(in_model,
                       in_config,
                       in_session,
                       target_file_path=None):
+    from deep_disfluency.utils.tools import convert_from_inc_disfluency_tags_to_eval_tags
+
     if target_file_path:
         target_file = open(target_file_path, "w")
 
     # eval tags --> RNN tags
-    X, ys_for_tasks = make_multitask_dataset(dataset,
-                                             vocabs_for_tasks[0][0],
-                                             vocabs_for_tasks[0][1],
-                                             in_config)
+    X, ys_for_tasks = vectorize_dataset(dataset,
+                                        vocabs_for_tasks[0][0],
+                                        vocabs_for_tasks[0][1],
+                                        in_config)
     predictions = predict(in_model,
                           (X, ys_for_tasks),
                           vocabs_for_tasks,
@@ -568,6 +647,12 @@ def eval_babi(in_model,
               in_config,
               in_session,
               verbose=True):
+    import pandas as pd
+    from deep_disfluency.utils.tools import convert_from_inc_disfluency_tags_to_eval_tags
+    from deep_disfluency.evaluation.disf_evaluation import (incremental_output_disfluency_eval_from_file,
+                                                            final_output_disfluency_eval_from_file)
+    from deep_disfluency.evaluation.eval_utils import rename_all_repairs_in_line_with_index
+
     increco_file = 'swbd_disf_heldout_data_output_increco.text'
     dataset = pd.read_json(source_file_path)
     predict_babi_file(in_model,
@@ -636,48 +721,121 @@ def eval_babi(in_model,
             'f1_<e_word': all_results['f1_<e_word']}
 
 
-def filter_line(in_line, in_model, in_vocabs_for_tasks, in_config, in_session):
+def filter_line(in_line, in_model, in_vocabs_for_tasks, in_config, in_session, model_ops=None):
     tokens = unicode(in_line.lower()).split()
-    dataset = pd.DataFrame({'utterance': [tokens],
-                            'tags': [['<f/>'] * len(tokens)],
-                            'pos': [pos_tag(tokens)]})
     (tag_vocab, tag_label_vocab, tag_rev_label_vocab) = in_vocabs_for_tasks[0]
-    X_line, ys_line = make_multitask_dataset(dataset, tag_vocab, tag_label_vocab, in_config)
-    result_tokens = predict(in_model, (X_line, ys_line), in_vocabs_for_tasks, in_session, batch_size=1)
+    token_ids, lengths = vectorize_rows([tokens], [pos_tag(tokens)], tag_vocab, in_config)
+    X_line = make_model_input(token_ids, lengths, in_config)
+    ys_line = make_task_labels([['<f/>'] * len(tokens)], token_ids, lengths, tag_label_vocab, in_config)
+    result_tokens = predict(in_model,
+                            (X_line, ys_line),
+                            in_vocabs_for_tasks,
+                            in_session,
+                            batch_size=1,
+                            model_ops=model_ops)
     return ' '.join(result_tokens)
 
 
 def create_model(in_vocab_size, in_cell_size, in_max_input_length, in_task_output_dimensions):
     with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
         X = tf.placeholder(tf.int32, [None, in_max_input_length], name='X')
-        ys_for_tasks = [tf.placeholder(tf.float32, [None, task_i_output_dimensions], name='y_{}'.format(task_idx))
-                        for task_idx, task_i_output_dimensions in enumerate(in_task_output_dimensions)]
-        embeddings = tf.Variable(tf.random_uniform([in_vocab_size, in_cell_size], -1.0, 1.0),
-                                 name='emb')
+        ys_for_tasks = [tf.placeholder(tf.int32, [None], name='y_{}'.format(task_idx))
+                        for task_idx in xrange(len(in_task_output_dimensions))]
+        embeddings, W_for_tasks, b_for_tasks = create_model_variables(in_vocab_size,
+                                                                      in_cell_size,
+                                                                      in_task_output_dimensions)
         emb = tf.nn.embedding_lookup(embeddings, X)
 
-        lstm_cell = rnn.BasicLSTMCell(in_cell_size, forget_bias=1.0, name='lstm')
+        lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(in_cell_size, forget_bias=1.0, name='lstm')
         outputs, states = tf.nn.dynamic_rnn(lstm_cell, emb, dtype=tf.float32)
 
-        W_for_tasks = [tf.Variable(tf.random_normal([in_cell_size, task_i_output_dim]),
-                                   name='W_{}'.format(task_idx))
-                       for task_idx, task_i_output_dim in enumerate(in_task_output_dimensions)]
-        b_for_tasks = [tf.Variable(tf.random_normal([task_i_output_dim]),
-                                   name='bias_{}'.format(task_idx))
-                       for task_idx, task_i_output_dim in enumerate(in_task_output_dimensions)]
+        hidden = tf.identity(outputs[:, -1, :], name='hidden')
 
-        task_outputs = [tf.add(tf.matmul(outputs[:, -1, :], W_task), b_task)
+        task_outputs = [tf.add(tf.matmul(hidden, W_task), b_task)
+                        for W_task, b_task in zip(W_for_tasks, b_for_tasks)]
+    return X, tuple(ys_for_tasks), task_outputs, hidden
+
+
+def create_sequence_model(in_vocab_size, in_cell_size, in_task_output_dimensions):
+    """Tags a whole utterance in one dynamic_rnn pass, the model's X being (padded utterances, lengths).
+    Logits are only emitted for the actual timesteps, flattened in the utterance-by-utterance
+    token order of the dataset labels"""
+    with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+        X = tf.placeholder(tf.int32, [None, None], name='X')
+        X_lengths = tf.placeholder(tf.int32, [None], name='X_lengths')
+        ys_for_tasks = [tf.placeholder(tf.int32, [None], name='y_{}'.format(task_idx))
+                        for task_idx in xrange(len(in_task_output_dimensions))]
+        embeddings, W_for_tasks, b_for_tasks = create_model_variables(in_vocab_size,
+                                                                      in_cell_size,
+                                                                      in_task_output_dimensions)
+        emb = tf.nn.embedding_lookup(embeddings, X)
+
+        lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(in_cell_size, forget_bias=1.0, name='lstm')
+        outputs, states = tf.nn.dynamic_rnn(lstm_cell, emb, sequence_length=X_lengths, dtype=tf.float32)
+        outputs_flat = tf.boolean_mask(outputs, tf.sequence_mask(X_lengths, tf.shape(X)[1]))
+        hidden = tf.identity(outputs_flat, name='hidden')
+
+        task_outputs = [tf.add(tf.matmul(hidden, W_task), b_task)
+                        for W_task, b_task in zip(W_for_tasks, b_for_tasks)]
+    return (X, X_lengths), tuple(ys_for_tasks), task_outputs, hidden
+
+
+def create_model_from_config(in_vocab_size, in_task_output_dimensions, in_config):
+    if in_config.get('model_type', 'windowed') == 'sequence':
+        return create_sequence_model(in_vocab_size,
+                                     in_config['embedding_size'],
+                                     in_task_output_dimensions)
+    return create_model(in_vocab_size,
+                        in_config['embedding_size'],
+                        in_config['max_input_length'],
+                        in_task_output_dimensions)
+
+
+def create_model_variables(in_vocab_size, in_cell_size, in_task_output_dimensions):
+    embeddings = tf.get_variable('emb',
+                                 [in_vocab_size, in_cell_size],
+                                 initializer=tf.random_uniform_initializer(-1.0, 1.0))
+    W_for_tasks = [tf.get_variable('W_{}'.format(task_idx),
+                                   [in_cell_size, task_i_output_dim],
+                                   initializer=tf.random_normal_initializer())
+                   for task_idx, task_i_output_dim in enumerate(in_task_output_dimensions)]
+    b_for_tasks = [tf.get_variable('bias_{}'.format(task_idx),
+                                   [task_i_output_dim],
+                                   initializer=tf.random_normal_initializer())
+                   for task_idx, task_i_output_dim in enumerate(in_task_output_dimensions)]
+    return embeddings, W_for_tasks, b_for_tasks
+
+
+def create_incremental_model(in_vocab_size, in_cell_size, in_task_output_dimensions):
+    """A single LSTM step over the variables of create_model():
+    takes one token per sequence together with the previous (c, h) state
+    and returns the next state and the task logits for that token"""
+    with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+        X_step = tf.placeholder(tf.int32, [None], name='X_step')
+        c_in = tf.placeholder(tf.float32, [None, in_cell_size], name='c_in')
+        h_in = tf.placeholder(tf.float32, [None, in_cell_size], name='h_in')
+        embeddings, W_for_tasks, b_for_tasks = create_model_variables(in_vocab_size,
+                                                                      in_cell_size,
+                                                                      in_task_output_dimensions)
+        emb = tf.nn.embedding_lookup(embeddings, X_step)
+
+        # the same scope dynamic_rnn uses, so that the step shares the trained LSTM weights
+        with tf.variable_scope('rnn'):
+            lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(in_cell_size, forget_bias=1.0, name='lstm', reuse=True)
+            output, (c_out, h_out) = lstm_cell(emb, tf.nn.rnn_cell.LSTMStateTuple(c_in, h_in))
+
+        task_outputs = [tf.add(tf.matmul(output, W_task), b_task)
                         for W_task, b_task in zip(W_for_tasks, b_for_tasks)]
-    return X, tuple(ys_for_tasks), task_outputs 
+    return X_step, (c_in, h_in), (c_out, h_out), task_outputs
 
 
 def load(in_model_folder, in_session, existing_model=None):
     with open(os.path.join(in_model_folder, VOCABULARY_NAME)) as vocab_in:
-        vocab = json.load(vocab_in)
+        vocab = Vocabulary(json.load(vocab_in))
     with open(os.path.join(in_model_folder, CHAR_VOCABULARY_NAME)) as char_vocab_in:
         char_vocab = json.load(char_vocab_in)
     with open(os.path.join(in_model_folder, LABEL_VOCABULARY_NAME)) as label_vocab_in:
-        label_vocab = json.load(label_vocab_in)
+        label_vocab = Vocabulary(json.load(label_vocab_in))
     with open(os.path.join(in_model_folder, CONFIG_NAME)) as config_in:
         config = json.load(config_in)
     task_output_dimensions = []
@@ -689,10 +847,7 @@ def load(in_model_folder, in_session, existing_model=None):
         else:
             raise NotImplementedError
     if not existing_model:
-        model = create_model(len(vocab),
-                             config['embedding_size'],
-                             config['max_input_length'],
-                             task_output_dimensions)
+        model = create_model_from_config(len(vocab), task_output_dimensions, config)
     else:
         model = existing_model
     loader = tf.train.Saver()
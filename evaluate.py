@@ -5,8 +5,6 @@ import sys
 import matplotlib
 matplotlib.use('agg')
 
-import tensorflow as tf
-
 THIS_FILE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(THIS_FILE_DIR,
                         'deep_disfluency',
@@ -17,7 +15,9 @@ DATA_DIR = os.path.join(THIS_FILE_DIR,
 sys.path.append(os.path.join(THIS_FILE_DIR, 'deep_disfluency'))
 DEFAULT_HELDOUT_DATASET = DATA_DIR + '/swbd_disf_heldout_data_timings.csv'
 
-from dialogue_denoiser_lstm import load, eval_deep_disfluency, eval_babi
+from config import read_config
+from dialogue_denoiser_lstm import load, eval_deep_disfluency, eval_babi, CONFIG_NAME
+from session_utils import configure_session_arguments, create_session, get_session_settings
 
 
 def configure_argument_parser():
@@ -25,12 +25,15 @@ def configure_argument_parser():
     parser.add_argument('model_folder')
     parser.add_argument('dataset')
     parser.add_argument('mode', help='[deep_disfluency/babi]')
+    configure_session_arguments(parser)
 
     return parser
 
 
-def main(in_dataset_file, in_model_folder, in_mode):
-    with tf.Session() as sess:
+def main(in_dataset_file, in_model_folder, in_mode, session_settings=None):
+    if session_settings is None:
+        session_settings = get_session_settings(read_config(os.path.join(in_model_folder, CONFIG_NAME)))
+    with create_session(session_settings) as sess:
         model, actual_config, vocab, char_vocab, label_vocab = load(in_model_folder,
                                                                     sess)
         rev_vocab = {word_id: word
@@ -59,4 +62,5 @@ if __name__ == '__main__':
     parser = configure_argument_parser()
     args = parser.parse_args()
 
-    main(args.dataset, args.model_folder, args.mode)
+    config = read_config(os.path.join(args.model_folder, CONFIG_NAME))
+    main(args.dataset, args.model_folder, args.mode, session_settings=get_session_settings(config, vars(args)))
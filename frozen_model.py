@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+from argparse import ArgumentParser
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from data_utils import Vocabulary
+from dialogue_denoiser_lstm import (load,
+                                    CONFIG_NAME,
+                                    VOCABULARY_NAME,
+                                    CHAR_VOCABULARY_NAME,
+                                    LABEL_VOCABULARY_NAME)
+
+FROZEN_MODEL_NAME = 'frozen_model.pb'
+TAG_LOGITS_NAME = 'tag_logits'
+GRAPH_TRANSFORMS = ['remove_nodes(op=CheckNumerics)',
+                    'fold_constants(ignore_errors=true)',
+                    'sort_by_execution_order']
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Export the LSTM dialogue filter as a frozen inference-only graph')
+    parser.add_argument('model_folder')
+    parser.add_argument('export_folder')
+
+    return parser
+
+
+def get_input_names(in_config):
+    if in_config.get('model_type', 'windowed') == 'sequence':
+        return ['model/X', 'model/X_lengths']
+    return ['model/X']
+
+
+def export_frozen_model(in_model_folder, in_export_folder):
+    """Embedding -> LSTM -> tag head with the variables turned into constants, and folded where possible.
+    The LM head, the labels and all the training ops are pruned"""
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model, config, vocab, char_vocab, label_vocab = load(in_model_folder, sess)
+        X, ys_for_tasks, logits_for_tasks, hidden = model
+        tf.identity(logits_for_tasks[config['tasks'].index('tag')], name=TAG_LOGITS_NAME)
+        graph_def = tf.graph_util.convert_variables_to_constants(sess,
+                                                                 sess.graph.as_graph_def(),
+                                                                 [TAG_LOGITS_NAME])
+    graph_def = TransformGraph(graph_def, get_input_names(config), [TAG_LOGITS_NAME], GRAPH_TRANSFORMS)
+    # colocations with the folded variables would point to nodes that no longer exist
+    for node in graph_def.node:
+        if '_class' in node.attr:
+            del node.attr['_class']
+
+    if not os.path.exists(in_export_folder):
+        os.makedirs(in_export_folder)
+    with tf.gfile.GFile(os.path.join(in_export_folder, FROZEN_MODEL_NAME), 'wb') as graph_out:
+        graph_out.write(graph_def.SerializeToString())
+    for file_name in [CONFIG_NAME, VOCABULARY_NAME, CHAR_VOCABULARY_NAME, LABEL_VOCABULARY_NAME]:
+        shutil.copy(os.path.join(in_model_folder, file_name), in_export_folder)
+
+
+def is_frozen_model(in_model_folder):
+    return os.path.exists(os.path.join(in_model_folder, FROZEN_MODEL_NAME))
+
+
+def load_frozen_model(in_model_folder, in_session):
+    """load() counterpart for the exported models: nothing but the tag head is built, and there are
+    no variables to restore. The model is (X, (), [tag logits], None), e.g. for create_prediction_ops()"""
+    with open(os.path.join(in_model_folder, VOCABULARY_NAME)) as vocab_in:
+        vocab = Vocabulary(json.load(vocab_in))
+    with open(os.path.join(in_model_folder, CHAR_VOCABULARY_NAME)) as char_vocab_in:
+        char_vocab = json.load(char_vocab_in)
+    with open(os.path.join(in_model_folder, LABEL_VOCABULARY_NAME)) as label_vocab_in:
+        label_vocab = Vocabulary(json.load(label_vocab_in))
+    with open(os.path.join(in_model_folder, CONFIG_NAME)) as config_in:
+        config = json.load(config_in)
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(os.path.join(in_model_folder, FROZEN_MODEL_NAME), 'rb') as graph_in:
+        graph_def.ParseFromString(graph_in.read())
+    with in_session.graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    graph = in_session.graph
+    X = tuple(graph.get_tensor_by_name(name + ':0') for name in get_input_names(config))
+    if len(X) == 1:
+        X = X[0]
+    tag_logits = graph.get_tensor_by_name(TAG_LOGITS_NAME + ':0')
+    return (X, (), [tag_logits], None), config, vocab, char_vocab, label_vocab
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    export_frozen_model(args.model_folder, args.export_folder)
@@ -0,0 +1,130 @@
+from collections import deque
+
+import numpy as np
+import tensorflow as tf
+
+from data_utils import PAD_ID, UNK_ID, pad_sequences
+from dialogue_denoiser_lstm import create_incremental_model, create_prediction_ops
+from pos_tag_dataset import IncrementalPOSTagger, DEFAULT_LEFT_CONTEXT
+
+
+class IncrementalTagger(object):
+    """Word-by-word disfluency tagger for live (e.g. ASR) input.
+
+    In the 'stateful' mode the LSTM state of every dialogue is carried
+    forward, and each incoming word costs exactly one cell step. The
+    state is primed with max_input_length - 1 PAD steps (i.e. the padded
+    context of the first word at training time), so the first word of an
+    utterance is tagged exactly as in the windowed model; later words see
+    the entire utterance prefix instead of the last max_input_length tokens.
+
+    The 'windowed' mode reproduces make_multitask_dataset()/predict()
+    semantics exactly by re-running the full model over the pre-padded
+    window of the last max_input_length tokens.
+
+    For sequence-level models (model_type 'sequence'), the state starts
+    from zeros and the 'stateful' mode is exact.
+    """
+    def __init__(self, in_model, in_vocabs_for_tasks, in_config, in_session, mode='stateful'):
+        self.is_sequence_model = in_config.get('model_type', 'windowed') == 'sequence'
+        if mode not in ['stateful', 'windowed'] or (mode == 'windowed' and self.is_sequence_model):
+            raise NotImplementedError
+        self.model = in_model
+        self.vocab, self.label_vocab, self.rev_label_vocab = in_vocabs_for_tasks[0]
+        self.config = in_config
+        self.session = in_session
+        self.mode = mode
+        self.states = {}
+
+        X, ys_for_tasks, logits_for_tasks, hidden = in_model
+        self.y_pred_op = create_prediction_ops(in_model)['y_pred'][0]
+        if self.mode == 'stateful':
+            self.cell_size = in_config['embedding_size']
+            task_output_dimensions = [logits_i.shape[1].value for logits_i in logits_for_tasks]
+            self.step_model = create_incremental_model(len(self.vocab),
+                                                       self.cell_size,
+                                                       task_output_dimensions)
+            X_step, _, _, step_logits_for_tasks = self.step_model
+            self.step_y_pred_op = tf.argmax(step_logits_for_tasks[0], 1)
+            self.initial_state = self._make_initial_state()
+
+    def _make_initial_state(self):
+        X_step, (c_in, h_in), (c_out, h_out), _ = self.step_model
+        c, h = np.zeros((1, self.cell_size)), np.zeros((1, self.cell_size))
+        if self.is_sequence_model:
+            return c, h
+        for _ in xrange(self.config['max_input_length'] - 1):
+            c, h = self.session.run([c_out, h_out], feed_dict={X_step: [PAD_ID], c_in: c, h_in: h})
+        return c, h
+
+    def _vectorize_token(self, in_word, in_pos):
+        if self.config['use_pos_tags']:
+            if in_pos is None:
+                raise ValueError('The model was trained with POS tags, but no POS tag was given')
+            token = u'{}_{}'.format(in_word, in_pos)
+        else:
+            token = in_word
+        return self.vocab.get(token, UNK_ID)
+
+    def reset(self, dialogue_id=None):
+        """Start a new utterance in the dialogue (or in all the dialogues if dialogue_id is None)"""
+        if dialogue_id is None:
+            self.states = {}
+        else:
+            self.states.pop(dialogue_id, None)
+
+    def tag(self, in_word, in_pos=None, dialogue_id=None):
+        token_id = self._vectorize_token(in_word, in_pos)
+        if self.mode == 'stateful':
+            X_step, (c_in, h_in), (c_out, h_out), _ = self.step_model
+            c, h = self.states.get(dialogue_id, self.initial_state)
+            c, h, y_pred = self.session.run([c_out, h_out, self.step_y_pred_op],
+                                            feed_dict={X_step: [token_id], c_in: c, h_in: h})
+            self.states[dialogue_id] = (c, h)
+        else:
+            X = self.model[0]
+            context = self.states.setdefault(dialogue_id,
+                                             deque([], maxlen=self.config['max_input_length']))
+            context.append(token_id)
+            X_context = pad_sequences([list(context)], self.config['max_input_length'])
+            y_pred = self.session.run(self.y_pred_op, feed_dict={X: X_context})
+        return self.rev_label_vocab[y_pred[0]]
+
+
+class StreamingTagger(object):
+    """Word-by-word tagging for the use_pos_tags models without the POS tags at hand: the words of every
+    dialogue go through an IncrementalPOSTagger and reach in_tagger (e.g. an IncrementalTagger) as soon as
+    their POS tags are decided, i.e. right_context words later. The LSTM state can't take a word back,
+    so the POS tags are never revised"""
+    def __init__(self, in_tagger, right_context=1, left_context=DEFAULT_LEFT_CONTEXT):
+        self.tagger = in_tagger
+        self.right_context = right_context
+        self.left_context = left_context
+        self.pos_taggers = {}
+
+    def reset(self, dialogue_id=None):
+        """Start a new utterance in the dialogue (or in all the dialogues if dialogue_id is None)"""
+        if dialogue_id is None:
+            self.pos_taggers = {}
+        else:
+            self.pos_taggers.pop(dialogue_id, None)
+        self.tagger.reset(dialogue_id)
+
+    def _tag_words(self, in_pos_tagged_words, dialogue_id):
+        return [(token_idx, word, self.tagger.tag(word, pos, dialogue_id=dialogue_id))
+                for token_idx, word, pos in in_pos_tagged_words]
+
+    def tag(self, in_word, dialogue_id=None):
+        """(token index, word, disfluency tag) of the words tagged after in_word arrived"""
+        pos_tagger = self.pos_taggers.setdefault(dialogue_id,
+                                                 IncrementalPOSTagger(right_context=self.right_context,
+                                                                      left_context=self.left_context))
+        return self._tag_words(pos_tagger.push(in_word), dialogue_id)
+
+    def flush(self, dialogue_id=None):
+        """Tags the words still waiting for their right context at the end of the utterance and starts a new one"""
+        result = []
+        if dialogue_id in self.pos_taggers:
+            result = self._tag_words(self.pos_taggers[dialogue_id].flush(), dialogue_id)
+        self.reset(dialogue_id)
+        return result
@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+
+from data_utils import PAD_ID, UNK_ID, augment_utterance, make_model_input, vectorize_rows, Vocabulary
+
+# the model folder contents as in dialogue_denoiser_lstm, which isn't imported to keep TensorFlow out
+MODEL_NAME = 'ckpt'
+VOCABULARY_NAME = 'vocab.json'
+CHAR_VOCABULARY_NAME = 'char_vocab.json'
+LABEL_VOCABULARY_NAME = 'label_vocab.json'
+CONFIG_NAME = 'config.json'
+NUMPY_MODEL_NAME = 'numpy_model.npz'
+
+LSTM_FORGET_BIAS = 1.0
+# the weights quantize_weights() applies to: the embedding table and the tag head
+QUANTIZABLE_WEIGHTS = ['emb', 'W']
+INT8_MAX = 127
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Export the LSTM dialogue filter for the NumPy inference backend')
+    parser.add_argument('model_folder')
+    parser.add_argument('export_folder')
+
+    return parser
+
+
+def export_numpy_model(in_model_folder, in_export_folder):
+    """The embeddings, LSTM and tag head weights of the checkpoint in a single .npz, plus the vocabularies"""
+    # TensorFlow is only needed for reading the checkpoint
+    import tensorflow as tf
+
+    with open(os.path.join(in_model_folder, CONFIG_NAME)) as config_in:
+        config = json.load(config_in)
+    tag_task_idx = config['tasks'].index('tag')
+    checkpoint = tf.train.NewCheckpointReader(os.path.join(in_model_folder, MODEL_NAME))
+    if not os.path.exists(in_export_folder):
+        os.makedirs(in_export_folder)
+    np.savez(os.path.join(in_export_folder, NUMPY_MODEL_NAME),
+             emb=checkpoint.get_tensor('model/emb'),
+             lstm_kernel=checkpoint.get_tensor('model/rnn/lstm/kernel'),
+             lstm_bias=checkpoint.get_tensor('model/rnn/lstm/bias'),
+             W=checkpoint.get_tensor('model/W_{}'.format(tag_task_idx)),
+             bias=checkpoint.get_tensor('model/bias_{}'.format(tag_task_idx)))
+    for file_name in [CONFIG_NAME, VOCABULARY_NAME, CHAR_VOCABULARY_NAME, LABEL_VOCABULARY_NAME]:
+        shutil.copy(os.path.join(in_model_folder, file_name), in_export_folder)
+
+
+def is_numpy_model(in_model_folder):
+    return os.path.exists(os.path.join(in_model_folder, NUMPY_MODEL_NAME))
+
+
+def quantize_weights(in_weights, in_dtype):
+    """QUANTIZABLE_WEIGHTS of the numpy_model arrays in float16, or in int8 with per-row float32 scales
+    (saved as '<name>_scale'); the other weights are kept as they are"""
+    weights = dict(in_weights)
+    for name in QUANTIZABLE_WEIGHTS:
+        if in_dtype == 'float16':
+            weights[name] = in_weights[name].astype(np.float16)
+        elif in_dtype == 'int8':
+            scale = np.max(np.abs(in_weights[name]), axis=1) / INT8_MAX
+            scale[scale == 0.0] = 1.0
+            weights[name] = np.round(in_weights[name] / scale[:, np.newaxis]).astype(np.int8)
+            weights[name + '_scale'] = scale.astype(np.float32)
+        else:
+            raise NotImplementedError
+    return weights
+
+
+def dequantize_rows(in_weights, in_name, in_row_ids=None):
+    """float32 rows of a possibly quantised weight matrix (all of them if in_row_ids is None)"""
+    rows = in_weights[in_name] if in_row_ids is None else in_weights[in_name][in_row_ids]
+    rows = rows.astype(np.float32)
+    if in_name + '_scale' in in_weights:
+        scale = in_weights[in_name + '_scale'] if in_row_ids is None else in_weights[in_name + '_scale'][in_row_ids]
+        rows *= scale[:, np.newaxis]
+    return rows
+
+
+def sigmoid(in_x):
+    return 0.5 * (np.tanh(0.5 * in_x) + 1.0)
+
+
+class NumpyModel(object):
+    """Forward pass of the tag head (embedding -> BasicLSTMCell -> dense) in NumPy,
+    for both the batched (predict()) and the incremental (step()) use.
+    Quantised embeddings (see quantize_weights()) stay quantised in memory, only the rows looked up are converted"""
+    def __init__(self, in_model_folder):
+        with open(os.path.join(in_model_folder, VOCABULARY_NAME)) as vocab_in:
+            self.vocab = Vocabulary(json.load(vocab_in))
+        with open(os.path.join(in_model_folder, LABEL_VOCABULARY_NAME)) as label_vocab_in:
+            self.label_vocab = Vocabulary(json.load(label_vocab_in))
+        with open(os.path.join(in_model_folder, CONFIG_NAME)) as config_in:
+            self.config = json.load(config_in)
+        self.rev_label_vocab = {label_id: label
+                                for label, label_id in self.label_vocab.iteritems()}
+        self.is_sequence_model = self.config.get('model_type', 'windowed') == 'sequence'
+        with np.load(os.path.join(in_model_folder, NUMPY_MODEL_NAME)) as weights_in:
+            weights = dict(weights_in)
+        self.emb = {name: weights[name] for name in ['emb', 'emb_scale'] if name in weights}
+        self.lstm_kernel, self.lstm_bias = weights['lstm_kernel'], weights['lstm_bias']
+        self.W, self.bias = dequantize_rows(weights, 'W'), weights['bias']
+        self.cell_size = self.emb['emb'].shape[1]
+        self._initial_state = self._make_initial_state()
+
+    def lstm_step(self, in_token_ids, in_state):
+        """One BasicLSTMCell step for a batch of tokens, in_state being (c, h)"""
+        c, h = in_state
+        gates = np.dot(np.concatenate([self.embed(in_token_ids), h], axis=1), self.lstm_kernel) + self.lstm_bias
+        i, j, f, o = np.split(gates, 4, axis=1)
+        c = c * sigmoid(f + LSTM_FORGET_BIAS) + sigmoid(i) * np.tanh(j)
+        h = np.tanh(c) * sigmoid(o)
+        return c, h
+
+    def embed(self, in_token_ids):
+        return dequantize_rows(self.emb, 'emb', in_token_ids)
+
+    def get_logits(self, in_hidden):
+        return np.dot(in_hidden, self.W) + self.bias
+
+    def _make_initial_state(self):
+        """Zeros for the sequence models, max_input_length - 1 PAD steps for the windowed ones
+        (see IncrementalTagger)"""
+        state = np.zeros((1, self.cell_size), dtype=np.float32), np.zeros((1, self.cell_size), dtype=np.float32)
+        if not self.is_sequence_model:
+            for _ in xrange(self.config['max_input_length'] - 1):
+                state = self.lstm_step(np.array([PAD_ID]), state)
+        return state
+
+    def initial_state(self, in_batch_size=1):
+        return tuple(np.repeat(state_i, in_batch_size, axis=0) for state_i in self._initial_state)
+
+    def step(self, in_token_ids, in_state):
+        """Incremental tagging of a batch of streams, one token per stream: (tag ids, new state)"""
+        state = self.lstm_step(np.asarray(in_token_ids), in_state)
+        return np.argmax(self.get_logits(state[1]), axis=1), state
+
+    def predict_logits(self, in_X):
+        """Tag logits for the model input of vectorize_utterances(), in the dataset token order"""
+        X = in_X[0] if self.is_sequence_model else in_X
+        state = (np.zeros((X.shape[0], self.cell_size), dtype=np.float32),
+                 np.zeros((X.shape[0], self.cell_size), dtype=np.float32))
+        if not self.is_sequence_model:
+            for timestep in xrange(X.shape[1]):
+                state = self.lstm_step(X[:, timestep], state)
+            return self.get_logits(state[1])
+        hidden = np.zeros((X.shape[0], X.shape[1], self.cell_size), dtype=np.float32)
+        for timestep in xrange(X.shape[1]):
+            state = self.lstm_step(X[:, timestep], state)
+            hidden[:, timestep] = state[1]
+        # valid timesteps only, utterance by utterance
+        lengths = in_X[1]
+        return self.get_logits(hidden[np.arange(X.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]])
+
+    def predict(self, in_X, batch_size=1024):
+        if self.is_sequence_model:
+            X, lengths = in_X
+            y_pred = []
+            for batch_start in xrange(0, X.shape[0], batch_size):
+                batch_lengths = lengths[batch_start: batch_start + batch_size]
+                batch_X = X[batch_start: batch_start + batch_size, :max(np.max(batch_lengths), 1)]
+                y_pred.append(np.argmax(self.predict_logits((batch_X, batch_lengths)), axis=1))
+        else:
+            y_pred = [np.argmax(self.predict_logits(in_X[batch_start: batch_start + batch_size]), axis=1)
+                      for batch_start in xrange(0, in_X.shape[0], batch_size)]
+        return np.concatenate(y_pred) if y_pred else np.zeros(0, dtype=np.int64)
+
+    def vectorize_token(self, in_word, in_pos=None):
+        if self.config['use_pos_tags'] and in_pos is None:
+            raise ValueError('The model was trained with POS tags, but no POS tag was given')
+        token = augment_utterance([in_word], [in_pos], self.config)[0]
+        return self.vocab.get(token, UNK_ID)
+
+
+class NumpyDenoiser(object):
+    """Denoiser over a NumpyModel: no TensorFlow, no session"""
+    def __init__(self, in_model_folder, batch_size=1024):
+        self.model = NumpyModel(in_model_folder)
+        self.config = self.model.config
+        self.batch_size = batch_size
+
+    def tag(self, in_utterances, in_pos=None):
+        if not sum(map(len, in_utterances)):
+            return [[] for _ in in_utterances]
+        if self.config['use_pos_tags'] and in_pos is None:
+            # the POS tagger is only needed by the POS models
+            from pos_tag_dataset import pos_tag_batch
+            in_pos = pos_tag_batch(in_utterances)
+        token_ids, lengths = vectorize_rows(in_utterances, in_pos, self.model.vocab, self.config)
+        y_pred = self.model.predict(make_model_input(token_ids, lengths, self.config), batch_size=self.batch_size)
+
+        tags, token_idx = [], 0
+        for utterance in in_utterances:
+            tags.append([self.model.rev_label_vocab[label_id]
+                         for label_id in y_pred[token_idx: token_idx + len(utterance)]])
+            token_idx += len(utterance)
+        return tags
+
+    def filter_lines(self, in_lines):
+        utterances = [unicode(line.lower()).split() for line in in_lines]
+        return [' '.join(tags) for tags in self.tag(utterances)]
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    export_numpy_model(args.model_folder, args.export_folder)
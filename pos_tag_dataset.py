@@ -1,42 +1,296 @@
+import json
 import os
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from glob import glob
+from multiprocessing import Pool, cpu_count
 from operator import itemgetter
 
-import pandas as pd
-from nltk import CRFTagger
-
 THIS_FILE_DIR = os.path.dirname(__file__)
 DEEP_DISFLUENCY_FOLDER = os.path.join(THIS_FILE_DIR, 'deep_disfluency')
 TAGGER_PATH = os.path.join(DEEP_DISFLUENCY_FOLDER, 'deep_disfluency/feature_extraction/crfpostagger')
 
-POS_TAGGER = CRFTagger()
-POS_TAGGER.set_model_file(TAGGER_PATH)
+POS_CACHE_SIZE = 100000
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_LEFT_CONTEXT = 8
+DEFAULT_SHARD_SIZE = 10000
+SHARD_NAME = 'shard_{:06d}.jsonl'
+SHARDS_MANIFEST_NAME = 'manifest.json'
+# shards read and queued for the pool at a time, per process
+SHARDS_IN_FLIGHT_PER_PROCESS = 2
+
+# created by get_pos_tagger() on the first use, nltk and the CRF model take a second to load
+POS_TAGGER = None
+
+
+class LRUCache(object):
+    """Mapping of at most max_size items, the least recently used ones are evicted first"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if self.max_size < len(self.items):
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+# POS tags of the recently tagged utterances by their token tuples, e.g. for the repeated interactive lines
+POS_CACHE = LRUCache(POS_CACHE_SIZE)
+
+
+def get_pos_tagger():
+    global POS_TAGGER
+    if POS_TAGGER is None:
+        from nltk import CRFTagger
+
+        POS_TAGGER = CRFTagger()
+        POS_TAGGER.set_model_file(TAGGER_PATH)
+    return POS_TAGGER
+
+
+def pos_tag_batch(in_utterances, use_cache=True):
+    """POS tags of a list of utterances (token lists), the ones not in POS_CACHE are tagged by a single tag_sents()"""
+    keys = map(tuple, in_utterances)
+    result = [POS_CACHE.get(key) if use_cache else None for key in keys]
+    missing_ids = [idx for idx, tags in enumerate(result) if tags is None]
+    if missing_ids:
+        tagged_utterances = get_pos_tagger().tag_sents([in_utterances[idx] for idx in missing_ids])
+        for idx, tagged_utterance in zip(missing_ids, tagged_utterances):
+            result[idx] = tuple(map(itemgetter(1), tagged_utterance))
+            if use_cache:
+                POS_CACHE.put(keys[idx], result[idx])
+    return map(list, result)
 
 
 def pos_tag(in_tokens):
-    tags = POS_TAGGER.tag(in_tokens)
-    return map(itemgetter(1), tags)
+    return pos_tag_batch([in_tokens])[0]
+
+
+class IncrementalPOSTagger(object):
+    """Word-by-word POS tagging for streaming input. A word's tag is decided once right_context more words
+    have arrived (or on flush()) by decoding the CRF over a bounded window: up to left_context words
+    before it and the right_context ones after it. The cost per word doesn't depend on the utterance length.
+
+    push() and flush() return the newly tagged (token index, word, pos) triples, ready for the use_pos_tags
+    models (e.g. IncrementalTagger.tag(word, pos)). With revise=True, the words whose tags changed
+    in the latest decoding are returned again with the new tags, unless they are within the first
+    max(left_context / 2, 1) words of a full window, where the decoding lacks their left context"""
+    def __init__(self, right_context=1, left_context=DEFAULT_LEFT_CONTEXT, revise=False):
+        self.right_context = right_context
+        self.left_context = left_context
+        self.revise = revise
+        self.reset()
+
+    def reset(self):
+        """Start a new utterance"""
+        self.window = deque([], maxlen=self.left_context + 1 + self.right_context)
+        # the tags of the words in the window that have been returned already
+        self.window_tags = deque()
+        self.tokens_number = 0
+        self.tagged_tokens_number = 0
+
+    def push(self, in_word):
+        self.window.append(in_word)
+        self.tokens_number += 1
+        return self._decode(self.tokens_number - self.right_context)
+
+    def flush(self):
+        """Tags of the words still waiting for their right context, the utterance is over after that"""
+        result = self._decode(self.tokens_number)
+        self.reset()
+        return result
+
+    def _decode(self, in_ready_tokens_number):
+        window_start = self.tokens_number - len(self.window)
+        # the words that left the window keep their tags
+        while self.window_tags and self.tagged_tokens_number - len(self.window_tags) < window_start:
+            self.window_tags.popleft()
+        if in_ready_tokens_number <= self.tagged_tokens_number and not self.revise:
+            return []
+        tags = pos_tag_batch([list(self.window)], use_cache=False)[0]
+        if not self.revise:
+            revisable_start = self.tagged_tokens_number
+        elif 0 < window_start:
+            revisable_start = window_start + max(self.left_context / 2, 1)
+        else:
+            revisable_start = 0
+        result = []
+        for token_idx in xrange(window_start, max(in_ready_tokens_number, self.tagged_tokens_number)):
+            tag = tags[token_idx - window_start]
+            if token_idx < self.tagged_tokens_number:
+                if token_idx < revisable_start:
+                    continue
+                if self.window_tags[token_idx - window_start] == tag:
+                    continue
+                self.window_tags[token_idx - window_start] = tag
+            else:
+                self.window_tags.append(tag)
+            result.append((token_idx, self.window[token_idx - window_start], tag))
+        self.tagged_tokens_number = max(in_ready_tokens_number, self.tagged_tokens_number)
+        return result
+
+
+def pos_tag_parallel(in_utterances, processes_number, batch_size=DEFAULT_BATCH_SIZE):
+    """pos_tag_batch() over batch_size chunks of in_utterances in a process pool, in the input order"""
+    batches = [in_utterances[batch_start: batch_start + batch_size]
+               for batch_start in xrange(0, len(in_utterances), batch_size)]
+    pool = Pool(processes_number)
+    try:
+        result = []
+        for batch_pos in pool.imap(pos_tag_batch, batches):
+            result += batch_pos
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def iterate_shards(in_src_file, in_shard_size):
+    """DataFrames of in_shard_size utterances, JSON lines files (*.jsonl) are read a shard at a time"""
+    import pandas as pd
+
+    if in_src_file.endswith('.jsonl'):
+        for shard in pd.read_json(in_src_file, lines=True, chunksize=in_shard_size):
+            yield shard
+    else:
+        dataset = pd.read_json(in_src_file).reset_index(drop=True)
+        for shard_start in xrange(0, dataset.shape[0], in_shard_size):
+            yield dataset.iloc[shard_start: shard_start + in_shard_size]
+
+
+def tag_shard(in_args):
+    """Writes the shard with its POS tags as JSON lines. The file only appears once complete"""
+    shard, shard_file, batch_size = in_args
+    utterances = list(shard['utterance'])
+    pos = []
+    for batch_start in xrange(0, len(utterances), batch_size):
+        pos += pos_tag_batch(utterances[batch_start: batch_start + batch_size])
+    temp_file = shard_file + '.tmp'
+    shard.assign(pos=pos).to_json(temp_file, orient='records', lines=True)
+    os.rename(temp_file, shard_file)
+    return shard_file
+
+
+def check_shards_manifest(in_src_file, in_shards_folder, in_shard_size):
+    """The shards of a previous run can only be reused for the same dataset file and shard size"""
+    manifest = {'dataset': os.path.abspath(in_src_file),
+                'dataset_size': os.path.getsize(in_src_file),
+                'dataset_mtime': os.path.getmtime(in_src_file),
+                'shard_size': in_shard_size}
+    manifest_file = os.path.join(in_shards_folder, SHARDS_MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as manifest_in:
+            if json.load(manifest_in) != manifest:
+                raise ValueError('{} holds the shards of another dataset or shard size'.format(in_shards_folder))
+    else:
+        with open(manifest_file, 'w') as manifest_out:
+            json.dump(manifest, manifest_out)
+
+
+def pos_tag_sharded(in_src_file,
+                    in_result_file,
+                    in_shards_folder,
+                    processes_number=cpu_count(),
+                    shard_size=DEFAULT_SHARD_SIZE,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """Tags the dataset shard by shard in a process pool, every worker loading the CRF model once.
+    The tagged shards are kept in in_shards_folder, so that a restarted run only tags the missing ones,
+    and are merged into in_result_file in the dataset order in the end"""
+    import pandas as pd
+
+    if not os.path.exists(in_shards_folder):
+        os.makedirs(in_shards_folder)
+    check_shards_manifest(in_src_file, in_shards_folder, shard_size)
+
+    def shard_tasks():
+        for shard_id, shard in enumerate(iterate_shards(in_src_file, shard_size)):
+            shard_file = os.path.join(in_shards_folder, SHARD_NAME.format(shard_id))
+            if os.path.exists(shard_file):
+                print 'Skipping the complete shard {}'.format(shard_file)
+                continue
+            yield shard, shard_file, batch_size
+
+    # Pool.imap*() would read and queue all the shards upfront, only a few are kept in flight instead
+    pool = Pool(processes_number)
+    pending = deque()
+    try:
+        for task in shard_tasks():
+            if SHARDS_IN_FLIGHT_PER_PROCESS * processes_number <= len(pending):
+                print 'Tagged {}'.format(pending.popleft().get())
+            pending.append(pool.apply_async(tag_shard, (task,)))
+        while pending:
+            print 'Tagged {}'.format(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # zero-padded shard ids sort in the dataset order
+    shard_files = sorted(glob(os.path.join(in_shards_folder, SHARD_NAME.replace('{:06d}', '*'))))
+    dataset = pd.concat([pd.read_json(shard_file, lines=True) for shard_file in shard_files], ignore_index=True)
+    save_dataset(dataset, in_result_file)
+
+
+def save_dataset(in_dataset, in_result_file):
+    if in_result_file.endswith('.jsonl'):
+        in_dataset.to_json(in_result_file, orient='records', lines=True)
+    else:
+        in_dataset.reset_index(drop=True).to_json(in_result_file)
 
 
 def configure_argument_parser():
     parser = ArgumentParser(description='POS tag dataset')
     parser.add_argument('dataset')
     parser.add_argument('result_file')
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='tagger processes')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='utterances per tag_sents() call')
+    parser.add_argument('--shards_folder',
+                        default=None,
+                        help='tag the dataset in shards kept in this folder, a restart skips the complete ones')
+    parser.add_argument('--shard_size', type=int, default=DEFAULT_SHARD_SIZE, help='utterances per shard')
 
     return parser
 
 
-def main(in_src_file, in_result_file):
+def main(in_src_file, in_result_file, processes_number=1, batch_size=DEFAULT_BATCH_SIZE):
+    import pandas as pd
+
     dataset = pd.read_json(in_src_file)
-    pos = []
-    for utterance in dataset['utterance']:
-        pos.append(pos_tag(utterance))
+    utterances = list(dataset['utterance'])
+    if 1 < processes_number:
+        pos = pos_tag_parallel(utterances, processes_number, batch_size=batch_size)
+    else:
+        pos = []
+        for batch_start in xrange(0, len(utterances), batch_size):
+            pos += pos_tag_batch(utterances[batch_start: batch_start + batch_size])
     dataset['pos'] = pos
-    dataset.reset_index(drop=True).to_json(in_result_file)
+    save_dataset(dataset, in_result_file)
 
 
 if __name__ == '__main__':
     parser = configure_argument_parser()
     args = parser.parse_args()
 
-    main(args.dataset, args.result_file)
+    if args.shards_folder:
+        pos_tag_sharded(args.dataset,
+                        args.result_file,
+                        args.shards_folder,
+                        processes_number=args.processes,
+                        shard_size=args.shard_size,
+                        batch_size=args.batch_size)
+    else:
+        main(args.dataset, args.result_file, processes_number=args.processes, batch_size=args.batch_size)
@@ -1,16 +1,16 @@
 from argparse import ArgumentParser
 import os
-from operator import itemgetter
 
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from sklearn.preprocessing import MinMaxScaler
 
 from config import read_config, DEFAULT_CONFIG_FILE
-from data_utils import make_vocabulary, make_char_vocabulary, make_multitask_dataset
-from training_utils import get_class_weight_proportional
-from dialogue_denoiser_lstm import create_model, train, save, load, post_train_lm
+from data_utils import count_dataset_rows, iterate_dataset_rows, make_vocabulary_from_counts, make_char_vocabulary
+from dataset_cache import get_vectorized_dataset, DEFAULT_CACHE_FOLDER
+from session_utils import configure_session_arguments, create_session, get_session_settings
+from training_utils import get_scaled_class_weight
+from dialogue_denoiser_lstm import create_model_from_config, train, save, load, post_train_lm
 
 
 def configure_argument_parser():
@@ -20,6 +20,10 @@ def configure_argument_parser():
     parser.add_argument('model_folder')
     parser.add_argument('--config', default=DEFAULT_CONFIG_FILE)
     parser.add_argument('--resume', action='store_true', default=False)
+    parser.add_argument('--cache_folder',
+                        default=DEFAULT_CACHE_FOLDER,
+                        help='where to keep the vectorised datasets between runs ("" to disable)')
+    configure_session_arguments(parser)
 
     return parser
 
@@ -27,19 +31,12 @@ def configure_argument_parser():
 def init_model(trainset, in_model_folder, resume, in_config, in_session):
     model = None
     if not resume:
-        if in_config['use_pos_tags']:
-            utterances = []
-            for utterance, postags in zip(trainset['utterance'], trainset['pos']):
-                utterance_augmented = ['{}_{}'.format(token, pos)
-                                       for token, pos in zip(utterance, postags)]
-                utterances.append(utterance_augmented)
-        else:
-            utterances = trainset['utterance']
-        vocab, _ = make_vocabulary(utterances, in_config['max_vocabulary_size'])
+        token_counts, label_counts = count_dataset_rows(iterate_dataset_rows(trainset), in_config)
+        vocab, _ = make_vocabulary_from_counts(token_counts, in_config['max_vocabulary_size'])
         char_vocab = make_char_vocabulary()
-        label_vocab, _ = make_vocabulary(trainset['tags'].values,
-                                         in_config['max_vocabulary_size'],
-                                         special_tokens=[])
+        label_vocab, _ = make_vocabulary_from_counts(label_counts,
+                                                     in_config['max_vocabulary_size'],
+                                                     special_tokens=[])
         task_output_dimensions = []
         for task in in_config['tasks']:
             if task == 'tag':
@@ -49,10 +46,7 @@ def init_model(trainset, in_model_folder, resume, in_config, in_session):
             else:
                 raise NotImplementedError
 
-        model = create_model(len(vocab),
-                             in_config['embedding_size'],
-                             in_config['max_input_length'],
-                             task_output_dimensions)
+        model = create_model_from_config(len(vocab), task_output_dimensions, in_config)
         init = tf.global_variables_initializer()
         in_session.run(init)
         save(in_config, vocab, char_vocab, label_vocab, in_model_folder, in_session)
@@ -62,16 +56,23 @@ def init_model(trainset, in_model_folder, resume, in_config, in_session):
     return model, actual_config, vocab, char_vocab, label_vocab
 
 
-def main(in_main_dataset_folder, in_lm_dataset_folder, in_model_folder, resume, in_config):
-    trainset_main = pd.read_json(os.path.join(in_main_dataset_folder, 'trainset.json'))
-    devset_main = pd.read_json(os.path.join(in_main_dataset_folder, 'devset.json'))
-    testset_main = pd.read_json(os.path.join(in_main_dataset_folder, 'testset.json'))
+def main(in_main_dataset_folder,
+         in_lm_dataset_folder,
+         in_model_folder,
+         resume,
+         in_config,
+         cache_folder=DEFAULT_CACHE_FOLDER,
+         session_settings=None):
+    trainset_main_file = os.path.join(in_main_dataset_folder, 'trainset.json')
+    devset_main_file = os.path.join(in_main_dataset_folder, 'devset.json')
+    testset_main_file = os.path.join(in_main_dataset_folder, 'testset.json')
+    trainset_lm_file = os.path.join(in_lm_dataset_folder, 'trainset.json')
 
-    trainset_lm = pd.read_json(os.path.join(in_lm_dataset_folder, 'trainset.json'))
-    devset_lm = pd.read_json(os.path.join(in_lm_dataset_folder, 'devset.json'))
-    testset_lm = pd.read_json(os.path.join(in_lm_dataset_folder, 'testset.json'))
+    trainset_main = pd.read_json(trainset_main_file)
 
-    with tf.Session() as sess:
+    if session_settings is None:
+        session_settings = get_session_settings(in_config)
+    with create_session(session_settings) as sess:
         model, actual_config, vocab, char_vocab, label_vocab = init_model(trainset_main,
                                                                           in_model_folder,
                                                                           resume,
@@ -81,31 +82,38 @@ def main(in_main_dataset_folder, in_lm_dataset_folder, in_model_folder, resume,
                      for word, word_id in vocab.iteritems()}
         rev_label_vocab = {label_id: label
                            for label, label_id in label_vocab.iteritems()}
-        _, ys_train_main = make_multitask_dataset(trainset_main,
+        _, ys_train_main = get_vectorized_dataset(trainset_main_file,
                                                   vocab,
                                                   label_vocab,
-                                                  actual_config)
-        X_dev_main, ys_dev_main = make_multitask_dataset(devset_main,
+                                                  actual_config,
+                                                  cache_folder=cache_folder,
+                                                  dataset=trainset_main)
+        X_dev_main, ys_dev_main = get_vectorized_dataset(devset_main_file,
                                                          vocab,
                                                          label_vocab,
-                                                         actual_config)
-        X_test_main, ys_test_main = make_multitask_dataset(testset_main,
+                                                         actual_config,
+                                                         cache_folder=cache_folder)
+        X_test_main, ys_test_main = get_vectorized_dataset(testset_main_file,
                                                            vocab,
                                                            label_vocab,
-                                                           actual_config)
+                                                           actual_config,
+                                                           cache_folder=cache_folder)
+        X_train_lm, ys_train_lm = get_vectorized_dataset(trainset_lm_file,
+                                                         vocab,
+                                                         label_vocab,
+                                                         actual_config,
+                                                         cache_folder=cache_folder)
 
-        y_train_flattened = np.argmax(ys_train_main[0], axis=-1)
+        y_train_flattened = ys_train_main[0]
         smoothing_coef = actual_config['class_weight_smoothing_coef']
-        class_weight = get_class_weight_proportional(y_train_flattened,
-                                                     smoothing_coef=smoothing_coef)
-
-        scaler = MinMaxScaler(feature_range=(1, 5))
-        class_weight_vector = scaler.fit_transform(np.array(map(itemgetter(1), sorted(class_weight.items(), key=itemgetter(0)))).reshape(-1, 1)).flatten()
+        class_weight_vector = get_scaled_class_weight(y_train_flattened,
+                                                      len(label_vocab),
+                                                      smoothing_coef=smoothing_coef)
 
         post_train_lm(model,
-                      (X_train, ys_train),
-                      (X_dev, ys_dev),
-                      (X_test, ys_test),
+                      (X_train_lm, ys_train_lm),
+                      (X_dev_main, ys_dev_main),
+                      (X_test_main, ys_test_main),
                       [(vocab, label_vocab, rev_label_vocab), (vocab, vocab, rev_vocab)],
                       in_model_folder,
                       actual_config['epochs_number'],
@@ -119,4 +127,10 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     config = read_config(args.config)
-    main(args.main_dataset_folder, args.lm_dataset_folder, args.model_folder, args.resume, config)
+    main(args.main_dataset_folder,
+         args.lm_dataset_folder,
+         args.model_folder,
+         args.resume,
+         config,
+         cache_folder=args.cache_folder,
+         session_settings=get_session_settings(config, vars(args)))
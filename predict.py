@@ -1,11 +1,12 @@
 from argparse import ArgumentParser
+import os
 
 import pandas as pd
-import tensorflow as tf
 
-from dialogue_denoiser_lstm import (predict,
-                                    load,
-                                    make_dataset)
+from config import read_config
+from data_utils import vectorize_dataset
+from dialogue_denoiser_lstm import predict, load, CONFIG_NAME
+from session_utils import configure_session_arguments, create_session, get_session_settings
 
 
 def configure_argument_parser():
@@ -13,19 +14,22 @@ def configure_argument_parser():
     parser.add_argument('dataset_folder')
     parser.add_argument('model_folder')
     parser.add_argument('result_file')
+    configure_session_arguments(parser)
     return parser
 
 
-def main(in_dataset_file, in_model_folder, in_result_file):
+def main(in_dataset_file, in_model_folder, in_result_file, session_settings=None):
     dataset = pd.read_json(in_dataset_file)
 
-    with tf.Session() as sess:
-       model, vocab, char_vocab, label_vocab = load(in_model_folder, sess)
+    if session_settings is None:
+        session_settings = get_session_settings(read_config(os.path.join(in_model_folder, CONFIG_NAME)))
+    with create_session(session_settings) as sess:
+       model, actual_config, vocab, char_vocab, label_vocab = load(in_model_folder, sess)
        rev_label_vocab = {label_id: label
                           for label, label_id in label_vocab.iteritems()}
        print 'Done loading'
-       X, y = make_dataset(dataset, vocab, label_vocab)
-       y_pred = predict(model, (X, y), rev_label_vocab, sess)
+       X, ys = vectorize_dataset(dataset, vocab, label_vocab, actual_config)
+       y_pred = predict(model, (X, ys), [(vocab, label_vocab, rev_label_vocab)], sess)
     tags_predicted = []
     tag_idx = 0
     for tag_seq in dataset['tags']:
@@ -41,5 +45,9 @@ if __name__ == '__main__':
     parser = configure_argument_parser()
     args = parser.parse_args()
 
-    main(args.dataset_folder, args.model_folder, args.result_file)
+    config = read_config(os.path.join(args.model_folder, CONFIG_NAME))
+    main(args.dataset_folder,
+         args.model_folder,
+         args.result_file,
+         session_settings=get_session_settings(config, vars(args)))
 
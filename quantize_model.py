@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import f1_score
+
+from data_utils import augment_utterance, iterate_dataset_rows, vectorize_sequences, vectorize_utterances
+from deep_disfluency_utils import get_tag_mapping
+from numpy_model import (export_numpy_model,
+                         is_numpy_model,
+                         quantize_weights,
+                         NumpyModel,
+                         NUMPY_MODEL_NAME,
+                         CONFIG_NAME,
+                         VOCABULARY_NAME,
+                         CHAR_VOCABULARY_NAME,
+                         LABEL_VOCABULARY_NAME)
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Quantise the embeddings and the tag head of a NumPy backend model')
+    parser.add_argument('model_folder', help='numpy_model export (or a trained model to export first)')
+    parser.add_argument('result_folder')
+    parser.add_argument('--dtype', default='int8', help='[int8/float16]')
+    parser.add_argument('--evaluate', help='dataset json file (e.g. the heldout devset.json) to compare the f1 on')
+
+    return parser
+
+
+def quantize_model(in_model_folder, in_result_folder, in_dtype):
+    """in_model_folder: a numpy_model export"""
+    with np.load(os.path.join(in_model_folder, NUMPY_MODEL_NAME)) as weights_in:
+        weights = dict(weights_in)
+    if not os.path.exists(in_result_folder):
+        os.makedirs(in_result_folder)
+    np.savez(os.path.join(in_result_folder, NUMPY_MODEL_NAME), **quantize_weights(weights, in_dtype))
+    for file_name in [CONFIG_NAME, VOCABULARY_NAME, CHAR_VOCABULARY_NAME, LABEL_VOCABULARY_NAME]:
+        shutil.copy(os.path.join(in_model_folder, file_name), in_result_folder)
+
+
+def evaluate(in_model, in_dataset):
+    """f1 of the disfluency tag groups as in dialogue_denoiser_lstm.evaluate()"""
+    rows = iterate_dataset_rows(in_dataset)
+    utterances = [augment_utterance(tokens, pos, in_model.config) for tokens, pos, tags in rows]
+    y_pred = in_model.predict(vectorize_utterances(utterances, in_model.vocab, in_model.config))
+    y_gold = np.concatenate(vectorize_sequences([tags for tokens, pos, tags in rows], in_model.label_vocab))
+    return {'f1_' + class_name: f1_score(y_true=y_gold, y_pred=y_pred, labels=class_ids, average='micro')
+            for class_name, class_ids in get_tag_mapping(in_model.label_vocab).iteritems()}
+
+
+def get_weights_size(in_model_folder):
+    return os.path.getsize(os.path.join(in_model_folder, NUMPY_MODEL_NAME))
+
+
+def main(in_model_folder, in_result_folder, in_dtype, in_eval_dataset_file=None):
+    source_folder = in_model_folder
+    if not is_numpy_model(in_model_folder):
+        source_folder = tempfile.mkdtemp()
+        export_numpy_model(in_model_folder, source_folder)
+    try:
+        quantize_model(source_folder, in_result_folder, in_dtype)
+        print '{}: {:.2f} MB -> {:.2f} MB'.format(in_dtype,
+                                                 get_weights_size(source_folder) / float(1 << 20),
+                                                 get_weights_size(in_result_folder) / float(1 << 20))
+        if in_eval_dataset_file is None:
+            return
+        dataset = pd.read_json(in_eval_dataset_file)
+        source_eval = evaluate(NumpyModel(source_folder), dataset)
+        quantized_eval = evaluate(NumpyModel(in_result_folder), dataset)
+    finally:
+        if source_folder != in_model_folder:
+            shutil.rmtree(source_folder)
+    for key in sorted(source_eval):
+        print '{}:\tfloat32 {:.4f}\t{} {:.4f}\t({:+.4f})'.format(key,
+                                                                 source_eval[key],
+                                                                 in_dtype,
+                                                                 quantized_eval[key],
+                                                                 quantized_eval[key] - source_eval[key])
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    main(args.model_folder, args.result_folder, args.dtype, in_eval_dataset_file=args.evaluate)
@@ -0,0 +1,55 @@
+import os
+import subprocess
+
+SESSION_CONFIG_FIELDS = ['intra_op_threads', 'inter_op_threads', 'cpu_affinity']
+
+
+def configure_session_arguments(in_parser):
+    """Command line options overriding the session settings of the config"""
+    in_parser.add_argument('--intra_op_threads',
+                           type=int,
+                           default=None,
+                           help='threads used within a TF op (0 for one per core)')
+    in_parser.add_argument('--inter_op_threads',
+                           type=int,
+                           default=None,
+                           help='TF ops run in parallel (0 for one per core)')
+    in_parser.add_argument('--cpu_affinity', default=None, help='CPUs to pin the process to, e.g. "0-3,8"')
+    return in_parser
+
+
+def get_session_settings(in_config, in_overrides=None):
+    """The config's intra_op_threads/inter_op_threads/cpu_affinity, overridden by the non-None
+    in_overrides values (e.g. vars() of the parsed command line arguments)"""
+    settings = {field: in_config.get(field) for field in SESSION_CONFIG_FIELDS}
+    if in_overrides is not None:
+        settings.update({field: in_overrides[field]
+                         for field in SESSION_CONFIG_FIELDS
+                         if in_overrides.get(field) is not None})
+    return settings
+
+
+def set_cpu_affinity(in_cpus):
+    """Pins all the threads of the process to in_cpus (a taskset CPU list, e.g. "0-3,8").
+    The threads started afterwards, e.g. TF's thread pools, inherit it"""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['taskset', '--all-tasks', '--cpu-list', '--pid', in_cpus, str(os.getpid())],
+                              stdout=devnull)
+
+
+def get_session_config(in_settings):
+    # imported here for the command line options to be usable without TensorFlow (e.g. by the NumPy backend)
+    import tensorflow as tf
+
+    return tf.ConfigProto(intra_op_parallelism_threads=in_settings.get('intra_op_threads') or 0,
+                          inter_op_parallelism_threads=in_settings.get('inter_op_threads') or 0)
+
+
+def create_session(in_settings, graph=None):
+    """tf.Session with the given threading, CPU pinning is applied to the whole process first.
+    TF creates its thread pools once per process, so all the sessions of a process should share the settings"""
+    import tensorflow as tf
+
+    if in_settings.get('cpu_affinity'):
+        set_cpu_affinity(in_settings['cpu_affinity'])
+    return tf.Session(graph=graph, config=get_session_config(in_settings))
@@ -0,0 +1,187 @@
+import json
+import os
+import random
+import sys
+import traceback
+from argparse import ArgumentParser
+from copy import deepcopy
+from itertools import product
+from multiprocessing import Manager, Pool
+
+import pandas as pd
+
+from config import read_config, DEFAULT_CONFIG_FILE
+from dataset_cache import DEFAULT_CACHE_FOLDER
+from session_utils import get_session_settings
+import train
+
+RESULTS_NAME = 'results.tsv'
+LOG_NAME = 'train.log'
+
+
+def configure_argument_parser():
+    parser = ArgumentParser(description='Hyperparameter sweep of train.py over config.json variants')
+    parser.add_argument('dataset_folder')
+    parser.add_argument('sweep_folder', help='trials\' model folders and logs, and the results table')
+    parser.add_argument('search_space', help='json file mapping config keys to lists of their values')
+    parser.add_argument('--config', default=DEFAULT_CONFIG_FILE, help='base config of the trials')
+    parser.add_argument('--search', default='grid', help='[grid/random]')
+    parser.add_argument('--trials', type=int, default=10, help='number of random search trials')
+    parser.add_argument('--processes', type=int, default=2, help='trials run in parallel')
+    parser.add_argument('--threads_per_process', type=int, default=1, help='TF intra/inter-op threads of a trial')
+    parser.add_argument('--epochs', type=int, default=None, help='overrides epochs_number of the config')
+    parser.add_argument('--kill_margin',
+                        type=float,
+                        default=0.1,
+                        help='trials this far below the best dev f1_rm at the same epoch are stopped')
+    parser.add_argument('--kill_after_epochs', type=int, default=3, help='epochs before a trial can be stopped')
+    parser.add_argument('--cache_folder',
+                        default=DEFAULT_CACHE_FOLDER,
+                        help='vectorised datasets shared by the trials')
+    parser.add_argument('--seed', type=int, default=273)
+
+    return parser
+
+
+def make_trials(in_base_config, in_search_space, search='grid', trials_number=None, seed=None):
+    """(params, config) pairs: every combination of the search space values (grid)
+    or trials_number of them picked at random"""
+    keys = sorted(in_search_space.keys())
+    value_combinations = list(product(*[in_search_space[key] for key in keys]))
+    if search == 'random':
+        value_combinations = random.Random(seed).sample(value_combinations,
+                                                        min(trials_number, len(value_combinations)))
+    elif search != 'grid':
+        raise NotImplementedError
+    trials = []
+    for values in value_combinations:
+        params = dict(zip(keys, values))
+        config = deepcopy(in_base_config)
+        config.update(params)
+        trials.append((params, config))
+    return trials
+
+
+def make_epoch_callback(in_best_f1_by_epoch, in_lock, in_kill_margin, in_kill_after_epochs, in_trial_state):
+    """Stops a trial whose dev f1_rm clearly trails the best one seen by any trial at the same epoch"""
+    def epoch_callback(in_epoch, in_dev_eval):
+        in_trial_state['epochs'] = in_epoch + 1
+        with in_lock:
+            best_f1 = max(in_best_f1_by_epoch.get(in_epoch, 0.0), in_dev_eval['f1_rm'])
+            in_best_f1_by_epoch[in_epoch] = best_f1
+        if in_kill_after_epochs <= in_epoch + 1 and in_dev_eval['f1_rm'] < best_f1 - in_kill_margin:
+            in_trial_state['status'] = 'stopped'
+            return False
+        return True
+    return epoch_callback
+
+
+def run_trial(in_trial):
+    (trial_id,
+     params,
+     config,
+     dataset_folder,
+     trial_folder,
+     cache_folder,
+     threads_number,
+     (best_f1_by_epoch, lock, kill_margin, kill_after_epochs)) = in_trial
+    if not os.path.exists(trial_folder):
+        os.makedirs(trial_folder)
+    # the trials run concurrently, each one logs into its own folder
+    sys.stdout = sys.stderr = open(os.path.join(trial_folder, LOG_NAME), 'w', 0)
+
+    trial_state = {'status': 'finished', 'epochs': 0}
+    result = {'trial': trial_id}
+    result.update({key: json.dumps(value) if isinstance(value, list) else value
+                   for key, value in params.iteritems()})
+    session_settings = get_session_settings(config, {'intra_op_threads': threads_number,
+                                                     'inter_op_threads': threads_number})
+    try:
+        dev_eval = train.main(dataset_folder,
+                              trial_folder,
+                              False,
+                              config,
+                              cache_folder=cache_folder,
+                              session_settings=session_settings,
+                              epoch_callback=make_epoch_callback(best_f1_by_epoch,
+                                                                 lock,
+                                                                 kill_margin,
+                                                                 kill_after_epochs,
+                                                                 trial_state))
+        result.update({'dev_f1_rm': dev_eval['f1_rm'], 'dev_f1_e': dev_eval['f1_e']})
+    except Exception:
+        traceback.print_exc()
+        trial_state['status'] = 'failed'
+    result.update(trial_state)
+    return result
+
+
+def save_results(in_results, in_param_names, in_file_name):
+    columns = ['trial'] + in_param_names + ['status', 'epochs', 'dev_f1_rm', 'dev_f1_e']
+    results = pd.DataFrame(in_results).reindex(columns=columns)
+    results = results.sort_values(by=['dev_f1_rm', 'dev_f1_e'], ascending=False)
+    results.to_csv(in_file_name, sep='\t', index=False, float_format='%.4f')
+    return results
+
+
+def main(in_dataset_folder,
+         in_sweep_folder,
+         in_search_space,
+         in_config,
+         search='grid',
+         trials_number=None,
+         processes_number=2,
+         threads_per_process=1,
+         kill_margin=0.1,
+         kill_after_epochs=3,
+         cache_folder=DEFAULT_CACHE_FOLDER,
+         seed=None):
+    trials = make_trials(in_config, in_search_space, search=search, trials_number=trials_number, seed=seed)
+    print 'Running {} trials in {} processes'.format(len(trials), processes_number)
+
+    manager = Manager()
+    kill_state = (manager.dict(), manager.Lock(), kill_margin, kill_after_epochs)
+    trial_args = [(trial_id,
+                   params,
+                   config,
+                   in_dataset_folder,
+                   os.path.join(in_sweep_folder, 'trial_{}'.format(trial_id)),
+                   cache_folder,
+                   threads_per_process,
+                   kill_state)
+                  for trial_id, (params, config) in enumerate(trials)]
+    # a fresh process for every trial, so that TF state doesn't leak between them
+    pool = Pool(processes_number, maxtasksperchild=1)
+    results = []
+    results_file = os.path.join(in_sweep_folder, RESULTS_NAME)
+    for result in pool.imap_unordered(run_trial, trial_args):
+        results.append(result)
+        print 'Trial {} {} ({} out of {} done)'.format(result['trial'], result['status'], len(results), len(trials))
+        results_table = save_results(results, sorted(in_search_space.keys()), results_file)
+    pool.close()
+    pool.join()
+    print results_table.to_string(index=False)
+
+
+if __name__ == '__main__':
+    parser = configure_argument_parser()
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    if args.epochs is not None:
+        config['epochs_number'] = args.epochs
+    search_space = read_config(args.search_space)
+    if not os.path.exists(args.sweep_folder):
+        os.makedirs(args.sweep_folder)
+    main(args.dataset_folder,
+         args.sweep_folder,
+         search_space,
+         config,
+         search=args.search,
+         trials_number=args.trials,
+         processes_number=args.processes,
+         threads_per_process=args.threads_per_process,
+         kill_margin=args.kill_margin,
+         kill_after_epochs=args.kill_after_epochs,
+         cache_folder=args.cache_folder,
+         seed=args.seed)
@@ -0,0 +1,204 @@
+"""Checks of the TF graphs and the NumPy backend on tiny random models, no trained model or dataset needed:
+python -m unittest test_models"""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from data_utils import iterate_dataset_rows, make_char_vocabulary, vectorize_dataset, Vocabulary, PAD, UNK
+from denoiser import Denoiser
+from dialogue_denoiser_lstm import create_evaluation_ops, create_model_from_config, evaluate, predict, save
+from frozen_model import export_frozen_model
+from incremental_tagger import IncrementalTagger
+from numpy_model import export_numpy_model, NumpyModel
+
+WORDS = ['i', 'uh', 'want', 'a', 'the', 'flight', 'to', 'boston', 'denver', 'no']
+LABELS = ['<f/>', '<e/>', '<rm-1/><rpEndSub/>', '<rpMid/>']
+CONFIG = {'model_type': 'windowed',
+          'embedding_size': 16,
+          'max_input_length': 4,
+          'use_pos_tags': False,
+          'tasks': ['tag', 'lm'],
+          'task_weights': [1.0, 0.1],
+          'l2_coef': 0.0001}
+CALLS_NUMBER = 3
+
+
+def make_random_dataset(in_utterances_number, seed=0):
+    random = np.random.RandomState(seed)
+    rows = []
+    for _ in xrange(in_utterances_number):
+        length = random.randint(1, 8)
+        rows.append({'utterance': map(str, random.choice(WORDS, length)),
+                     'tags': map(str, random.choice(LABELS, length))})
+    return pd.DataFrame(rows)
+
+
+def make_vocabularies():
+    vocab = Vocabulary((word, idx) for idx, word in enumerate([PAD, UNK] + WORDS))
+    label_vocab = Vocabulary((label, idx) for idx, label in enumerate(LABELS))
+    rev_label_vocab = {label_id: label for label, label_id in label_vocab.iteritems()}
+    return vocab, label_vocab, rev_label_vocab
+
+
+def get_config(in_model_type):
+    config = dict(CONFIG)
+    config['model_type'] = in_model_type
+    return config
+
+
+class GraphOpsTest(unittest.TestCase):
+    """evaluate() and predict() with shared model_ops must not grow the graph call after call"""
+    def check_graph_size_is_constant(self, in_config):
+        vocab, label_vocab, rev_label_vocab = make_vocabularies()
+        task_output_dimensions = [len(label_vocab), len(vocab)]
+        class_weights = [np.ones(dim) for dim in task_output_dimensions]
+        tag_map = {'e': [label_vocab['<e/>']]}
+        with tf.Graph().as_default() as graph, tf.Session() as sess:
+            model = create_model_from_config(len(vocab), task_output_dimensions, in_config)
+            model_ops = create_evaluation_ops(model, class_weights, in_config['task_weights'], in_config)
+            sess.run(tf.global_variables_initializer())
+            dataset = vectorize_dataset(make_random_dataset(20), vocab, label_vocab, in_config)
+
+            ops_number = len(graph.get_operations())
+            for _ in xrange(CALLS_NUMBER):
+                evaluate(model,
+                         dataset,
+                         tag_map,
+                         class_weights,
+                         in_config['task_weights'],
+                         in_config,
+                         sess,
+                         model_ops=model_ops)
+                predict(model, dataset, [(vocab, label_vocab, rev_label_vocab)], sess, model_ops=model_ops)
+                self.assertEqual(len(graph.get_operations()), ops_number)
+
+    def test_windowed_model(self):
+        self.check_graph_size_is_constant(get_config('windowed'))
+
+    def test_sequence_model(self):
+        self.check_graph_size_is_constant(get_config('sequence'))
+
+
+class SequenceLossTest(unittest.TestCase):
+    """A sequence batch of batch_size utterances has the loss of batch_size tokens, the mean one per real token"""
+    def test_loss_is_per_token(self):
+        config = get_config('sequence')
+        config['l2_coef'] = 0.0
+        vocab, label_vocab, rev_label_vocab = make_vocabularies()
+        task_output_dimensions = [len(label_vocab), len(vocab)]
+        class_weights = [np.ones(dim) for dim in task_output_dimensions]
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = create_model_from_config(len(vocab), task_output_dimensions, config)
+            model_ops = create_evaluation_ops(model, class_weights, config['task_weights'], config)
+            sess.run(tf.global_variables_initializer())
+            (X_padded, lengths), ys = vectorize_dataset(make_random_dataset(16, seed=4), vocab, label_vocab, config)
+            feed_dict = {model[0][0]: X_padded, model[0][1]: lengths}
+            feed_dict.update(zip(model[1], ys))
+            loss, logits_for_tasks = sess.run([model_ops['loss'], model[2]], feed_dict=feed_dict)
+
+        token_losses = 0.0
+        for logits, y, task_weight in zip(logits_for_tasks, ys, config['task_weights']):
+            log_probs = logits - np.log(np.sum(np.exp(logits), axis=1, keepdims=True))
+            token_losses += -log_probs[np.arange(y.shape[0]), y] * task_weight
+        self.assertAlmostEqual(loss, lengths.shape[0] * np.mean(token_losses), places=3)
+
+
+class IncrementalTaggerTest(unittest.TestCase):
+    """The windowed mode of IncrementalTagger tags word by word exactly as predict() does over the dataset"""
+    def test_windowed_mode(self):
+        config = get_config('windowed')
+        vocab, label_vocab, rev_label_vocab = make_vocabularies()
+        dataset = make_random_dataset(20, seed=2)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = create_model_from_config(len(vocab), [len(label_vocab), len(vocab)], config)
+            sess.run(tf.global_variables_initializer())
+            X, ys = vectorize_dataset(dataset, vocab, label_vocab, config)
+            y_pred = predict(model, (X, ys), [(vocab, label_vocab, rev_label_vocab)], sess, batch_size=16)
+
+            tagger = IncrementalTagger(model, [(vocab, label_vocab, rev_label_vocab)], config, sess, mode='windowed')
+            y_pred_incremental = []
+            for utterance, pos, tags in iterate_dataset_rows(dataset):
+                tagger.reset()
+                y_pred_incremental += [tagger.tag(word) for word in utterance]
+        self.assertEqual(y_pred_incremental, y_pred)
+
+
+class NumpyBackendTest(unittest.TestCase):
+    """The NumPy backend export of a random checkpoint predicts the same tags as TF predict() and IncrementalTagger"""
+    def setUp(self):
+        self.model_folder = tempfile.mkdtemp()
+        self.export_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_folder)
+        shutil.rmtree(self.export_folder)
+
+    def check_parity(self, in_config):
+        vocab, label_vocab, rev_label_vocab = make_vocabularies()
+        dataset = make_random_dataset(50, seed=1)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = create_model_from_config(len(vocab), [len(label_vocab), len(vocab)], in_config)
+            sess.run(tf.global_variables_initializer())
+            save(in_config, vocab, make_char_vocabulary(), label_vocab, self.model_folder, sess)
+            export_numpy_model(self.model_folder, self.export_folder)
+            numpy_model = NumpyModel(self.export_folder)
+
+            X, ys = vectorize_dataset(dataset, vocab, label_vocab, in_config)
+            tag_logits_tf = sess.run(model[2][0], feed_dict={model[0]: X})
+            np.testing.assert_allclose(numpy_model.predict_logits(X), tag_logits_tf, rtol=1e-4, atol=1e-4)
+            y_pred_tf = predict(model, (X, ys), [(vocab, label_vocab, rev_label_vocab)], sess, batch_size=16)
+            self.assertEqual(map(rev_label_vocab.get, numpy_model.predict(X, batch_size=16)), y_pred_tf)
+
+            tagger = IncrementalTagger(model, [(vocab, label_vocab, rev_label_vocab)], in_config, sess)
+            for utterance, pos, tags in iterate_dataset_rows(dataset):
+                tagger.reset()
+                state = numpy_model.initial_state()
+                for word in utterance:
+                    y_pred, state = numpy_model.step([numpy_model.vectorize_token(word)], state)
+                    self.assertEqual(rev_label_vocab[y_pred[0]], tagger.tag(word))
+
+    def test_windowed_model(self):
+        self.check_parity(get_config('windowed'))
+
+    def test_sequence_model(self):
+        self.check_parity(get_config('sequence'))
+
+
+class FrozenModelTest(unittest.TestCase):
+    """Denoiser over a frozen_model export of a random checkpoint tags as it does over the checkpoint"""
+    def setUp(self):
+        self.model_folder = tempfile.mkdtemp()
+        self.export_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_folder)
+        shutil.rmtree(self.export_folder)
+
+    def check_denoiser_tags(self, in_config):
+        vocab, label_vocab, rev_label_vocab = make_vocabularies()
+        utterances = list(make_random_dataset(30, seed=3)['utterance'])
+        with tf.Graph().as_default(), tf.Session() as sess:
+            create_model_from_config(len(vocab), [len(label_vocab), len(vocab)], in_config)
+            sess.run(tf.global_variables_initializer())
+            save(in_config, vocab, make_char_vocabulary(), label_vocab, self.model_folder, sess)
+        export_frozen_model(self.model_folder, self.export_folder)
+
+        tags = {}
+        for model_folder in [self.model_folder, self.export_folder]:
+            with tf.Graph().as_default(), tf.Session() as sess:
+                tags[model_folder] = Denoiser(model_folder, sess, batch_size=16).tag(utterances)
+        self.assertEqual(tags[self.export_folder], tags[self.model_folder])
+
+    def test_windowed_model(self):
+        self.check_denoiser_tags(get_config('windowed'))
+
+    def test_sequence_model(self):
+        self.check_denoiser_tags(get_config('sequence'))
+
+
+if __name__ == '__main__':
+    unittest.main()
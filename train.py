@@ -1,16 +1,26 @@
 from argparse import ArgumentParser
+from collections import Counter
+from itertools import chain
 import os
-from operator import itemgetter
 
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from sklearn.preprocessing import MinMaxScaler
 
 from config import read_config, DEFAULT_CONFIG_FILE
-from data_utils import make_vocabulary, make_char_vocabulary, make_multitask_dataset
-from training_utils import get_class_weight_proportional, get_sample_weight
-from dialogue_denoiser_lstm import (create_model,
+from build_vocabulary import load_vocabularies
+from data_utils import (count_dataset_rows,
+                        make_vocabulary_from_counts,
+                        make_char_vocabulary,
+                        iterate_dataset_file,
+                        iterate_dataset_rows)
+from dataset_cache import get_vectorized_dataset, DEFAULT_CACHE_FOLDER
+from session_utils import configure_session_arguments, create_session, get_session_settings
+from training_utils import (get_label_freqs,
+                            get_label_freqs_from_counts,
+                            get_scaled_class_weight_from_freqs,
+                            stream_batch_generator)
+from dialogue_denoiser_lstm import (create_model_from_config,
                                     train,
                                     save,
                                     load)
@@ -22,26 +32,35 @@ def configure_argument_parser():
     parser.add_argument('model_folder')
     parser.add_argument('--config', default=DEFAULT_CONFIG_FILE)
     parser.add_argument('--resume', action='store_true', default=False)
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        default=False,
+                        help='vectorise the trainset batch by batch instead of in memory'
+                             ' (trainset.jsonl is read chunk by chunk if present)')
+    parser.add_argument('--cache_folder',
+                        default=DEFAULT_CACHE_FOLDER,
+                        help='where to keep the vectorised datasets between runs ("" to disable)')
+    parser.add_argument('--vocabulary_folder',
+                        default=None,
+                        help='use the vocabularies of build_vocabulary.py instead of counting the trainset')
+    configure_session_arguments(parser)
 
     return parser
 
 
-def init_model(trainset, in_model_folder, resume, in_config, in_session):
+def init_model(in_trainset_rows, in_model_folder, resume, in_config, in_session, vocabulary_folder=None):
+    """in_trainset_rows: function returning a new iterator over the trainset's (utterance, pos, tags) rows"""
     model = None
     if not resume:
-        if in_config['use_pos_tags']:
-            utterances = []
-            for utterance, postags in zip(trainset['utterance'], trainset['pos']):
-                utterance_augmented = ['{}_{}'.format(token, pos)
-                                       for token, pos in zip(utterance, postags)]
-                utterances.append(utterance_augmented)
+        if vocabulary_folder:
+            vocab, label_vocab = load_vocabularies(vocabulary_folder)
         else:
-            utterances = trainset['utterance']
-        vocab, _ = make_vocabulary(utterances, in_config['max_vocabulary_size'])
+            token_counts, label_counts = count_dataset_rows(in_trainset_rows(), in_config)
+            vocab, _ = make_vocabulary_from_counts(token_counts, in_config['max_vocabulary_size'])
+            label_vocab, _ = make_vocabulary_from_counts(label_counts,
+                                                         in_config['max_vocabulary_size'],
+                                                         special_tokens=[])
         char_vocab = make_char_vocabulary()
-        label_vocab, _ = make_vocabulary(trainset['tags'].values,
-                                         in_config['max_vocabulary_size'],
-                                         special_tokens=[])
         task_output_dimensions = []
         for task in in_config['tasks']:
             if task == 'tag':
@@ -51,10 +70,7 @@ def init_model(trainset, in_model_folder, resume, in_config, in_session):
             else:
                 raise NotImplementedError
 
-        model = create_model(len(vocab),
-                             in_config['embedding_size'],
-                             in_config['max_input_length'],
-                             task_output_dimensions)
+        model = create_model_from_config(len(vocab), task_output_dimensions, in_config)
         init = tf.global_variables_initializer()
         in_session.run(init)
         save(in_config, vocab, char_vocab, label_vocab, in_model_folder, in_session)
@@ -64,43 +80,95 @@ def init_model(trainset, in_model_folder, resume, in_config, in_session):
     return model, actual_config, vocab, char_vocab, label_vocab
 
 
-def main(in_dataset_folder, in_model_folder, resume, in_config):
-    trainset, devset, testset = (pd.read_json(os.path.join(in_dataset_folder, 'trainset.json')),
-                                 pd.read_json(os.path.join(in_dataset_folder, 'devset.json')),
-                                 pd.read_json(os.path.join(in_dataset_folder, 'testset.json')))
-    with tf.Session() as sess:
-        model, actual_config, vocab, char_vocab, label_vocab = init_model(trainset,
+def main(in_dataset_folder,
+         in_model_folder,
+         resume,
+         in_config,
+         streaming=False,
+         cache_folder=DEFAULT_CACHE_FOLDER,
+         session_settings=None,
+         epoch_callback=None,
+         vocabulary_folder=None):
+    """session_settings: TF threading and CPU pinning (see session_utils), the config's by default.
+    Returns the dev results of the best epoch (see train())"""
+    trainset_file = os.path.join(in_dataset_folder, 'trainset.json')
+    devset_file, testset_file = (os.path.join(in_dataset_folder, 'devset.json'),
+                                 os.path.join(in_dataset_folder, 'testset.json'))
+    trainset = None
+    if streaming:
+        if os.path.exists(trainset_file + 'l'):
+            trainset_file += 'l'
+        trainset_rows = lambda: iterate_dataset_file(trainset_file)
+    elif resume:
+        # the vocabularies come from the model, and the vectorised trainset may be cached
+        trainset_rows = lambda: iterate_dataset_file(trainset_file)
+    else:
+        trainset = pd.read_json(trainset_file)
+        trainset_rows = lambda: iterate_dataset_rows(trainset)
+    if session_settings is None:
+        session_settings = get_session_settings(in_config)
+    with create_session(session_settings) as sess:
+        model, actual_config, vocab, char_vocab, label_vocab = init_model(trainset_rows,
                                                                           in_model_folder,
                                                                           resume,
                                                                           in_config,
-                                                                          sess)
+                                                                          sess,
+                                                                          vocabulary_folder=vocabulary_folder)
         rev_vocab = {word_id: word
                      for word, word_id in vocab.iteritems()}
         rev_label_vocab = {label_id: label
                            for label, label_id in label_vocab.iteritems()}
-        X_train, ys_train = make_multitask_dataset(trainset, vocab, label_vocab, actual_config)
-        X_dev, ys_dev = make_multitask_dataset(devset, vocab, label_vocab, actual_config)
-        X_test, ys_test = make_multitask_dataset(testset, vocab, label_vocab, actual_config)
-
-        y_train_flattened = np.argmax(ys_train[0], axis=-1)
-        class_weight = get_class_weight_proportional(y_train_flattened,
-                                                     smoothing_coef=actual_config['class_weight_smoothing_coef'])
-
-        scaler = MinMaxScaler(feature_range=(1, 5))
-        class_weight_vector = scaler.fit_transform(np.array(map(itemgetter(1), sorted(class_weight.items(), key=itemgetter(0)))).reshape(-1, 1)).flatten()
-
-
-        train(model,
-              (X_train, ys_train),
-              (X_dev, ys_dev),
-              (X_test, ys_test),
-              [(vocab, label_vocab, rev_label_vocab), (vocab, vocab, rev_vocab)],
-              in_model_folder,
-              actual_config['epochs_number'],
-              actual_config,
-              sess,
-              class_weights=[class_weight_vector, np.ones(len(vocab))],
-              task_weights=config['task_weights'])
+        if streaming:
+            train_data = None
+            # the tag counts only, memory doesn't grow with the trainset size
+            label_counts = Counter(chain.from_iterable(tags for utterance, pos, tags in trainset_rows()))
+            label_freqs = get_label_freqs_from_counts(label_counts, label_vocab)
+
+            def train_batches():
+                return stream_batch_generator(trainset_file,
+                                              vocab,
+                                              label_vocab,
+                                              actual_config,
+                                              actual_config['batch_size'])
+        else:
+            train_data = get_vectorized_dataset(trainset_file,
+                                                vocab,
+                                                label_vocab,
+                                                actual_config,
+                                                cache_folder=cache_folder,
+                                                bucket_by_length=True,
+                                                dataset=trainset)
+            # the training arrays are memory-mapped from the cache, the parsed trainset isn't needed anymore
+            trainset = None
+            label_freqs = get_label_freqs(train_data[1][0], len(label_vocab))
+            train_batches = None
+        X_dev, ys_dev = get_vectorized_dataset(devset_file,
+                                               vocab,
+                                               label_vocab,
+                                               actual_config,
+                                               cache_folder=cache_folder)
+        X_test, ys_test = get_vectorized_dataset(testset_file,
+                                                 vocab,
+                                                 label_vocab,
+                                                 actual_config,
+                                                 cache_folder=cache_folder)
+
+        smoothing_coef = actual_config['class_weight_smoothing_coef']
+        class_weight_vector = get_scaled_class_weight_from_freqs(label_freqs, smoothing_coef=smoothing_coef)
+
+        return train(model,
+                     train_data,
+                     (X_dev, ys_dev),
+                     (X_test, ys_test),
+                     [(vocab, label_vocab, rev_label_vocab), (vocab, vocab, rev_vocab)],
+                     in_model_folder,
+                     actual_config['epochs_number'],
+                     actual_config,
+                     sess,
+                     class_weights=[class_weight_vector, np.ones(len(vocab))],
+                     task_weights=actual_config['task_weights'],
+                     train_batches=train_batches,
+                     epoch_callback=epoch_callback)
 
 
 if __name__ == '__main__':
@@ -108,4 +176,11 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     config = read_config(args.config)
-    main(args.dataset_folder, args.model_folder, args.resume, config)
+    main(args.dataset_folder,
+         args.model_folder,
+         args.resume,
+         config,
+         streaming=args.streaming,
+         cache_folder=args.cache_folder,
+         session_settings=get_session_settings(config, vars(args)),
+         vocabulary_folder=args.vocabulary_folder)
@@ -1,45 +1,109 @@
-from collections import defaultdict, deque
+from collections import deque
+from itertools import islice
 from math import sin, pi
+from Queue import Full, Queue
+import sys
+from threading import Event, Thread
 
 import numpy as np
-from sklearn.utils.class_weight import compute_class_weight
 import tensorflow as tf
 
+from data_utils import iterate_dataset_file, make_model_input, make_task_labels, vectorize_rows, UNK_ID
 
-def get_sample_weight(in_labels, in_class_weight_map):
-    sample_weight = np.vectorize(in_class_weight_map.get)(in_labels)
-    return sample_weight
+DEFAULT_PREFETCH_BATCHES = 16
+# how often a prefetching thread waiting for space in the queue checks if the consumer has stopped, sec
+PREFETCH_PUT_TIMEOUT = 0.1
 
 
-def get_class_weight_sqrt(in_labels):
-    label_freqs = defaultdict(lambda: 0)
-    for label in in_labels:
-        label_freqs[label] += 1.0
-    label_weights = {label: 1.0 / np.power(freq, 1 / 3.) for label, freq in label_freqs.iteritems()}
+def get_sample_weight(in_labels, in_class_weight):
+    """in_class_weight: dense vector of weights indexed by class id"""
+    return np.take(in_class_weight, in_labels)
+
+
+def get_label_freqs(in_labels, classes_number=None):
+    return np.bincount(in_labels, minlength=classes_number or 0).astype(np.float64)
+
+
+def get_label_freqs_from_counts(in_label_counts, in_label_vocab):
+    """get_label_freqs() of the label -> count mapping (e.g. of count_dataset_rows()), unknown labels as UNK_ID"""
+    label_freqs = np.zeros(len(in_label_vocab), dtype=np.float64)
+    for label, count in in_label_counts.iteritems():
+        label_freqs[in_label_vocab.get(label, UNK_ID)] += count
+    return label_freqs
+
+
+def get_class_weight_sqrt(in_labels, classes_number=None):
+    """Dense vector of class weights indexed by class id, 0.0 for the classes absent from in_labels"""
+    label_freqs = get_label_freqs(in_labels, classes_number)
+    label_weights = np.zeros_like(label_freqs)
+    present = 0 < label_freqs
+    label_weights[present] = 1.0 / np.power(label_freqs[present], 1 / 3.)
+    return label_weights
+
+
+def get_class_weight_proportional(in_labels, smoothing_coef=1.0, classes_number=None):
+    """Dense vector of class weights indexed by class id, 0.0 for the classes absent from in_labels"""
+    return get_class_weight_proportional_from_freqs(get_label_freqs(in_labels, classes_number),
+                                                    smoothing_coef=smoothing_coef)
+
+
+def get_class_weight_proportional_from_freqs(in_label_freqs, smoothing_coef=1.0):
+    label_weights = np.zeros_like(in_label_freqs)
+    present = 0 < in_label_freqs
+    label_weights[present] = 1.0 / np.power(in_label_freqs[present], 1.0 / smoothing_coef)
     return label_weights
 
 
-def get_class_weight_proportional(in_labels, smoothing_coef=1.0):
-    label_freqs = defaultdict(lambda: 0)
-    for label in in_labels:
-        label_freqs[label] += 1.0
-    label_weights = {label: 1.0 / np.power(float(freq), 1.0 / smoothing_coef)
-                     for label, freq in label_freqs.iteritems()}
+def get_class_weight_auto(in_labels, classes_number=None):
+    """Dense vector of class weights indexed by class id, 0.0 for the classes absent from in_labels"""
+    # sklearn is imported on the first use, the inference code doesn't need it
+    from sklearn.utils.class_weight import compute_class_weight
+
+    label_freqs = get_label_freqs(in_labels, classes_number)
+    label_weights = np.zeros_like(label_freqs)
+    present = 0 < label_freqs
+    label_weights[present] = compute_class_weight('balanced', np.flatnonzero(present), in_labels)
     return label_weights
 
 
-def get_class_weight_auto(in_labels):
-    class_weight = compute_class_weight('balanced', np.unique(in_labels), in_labels)
-    class_weight_map = {class_id: weight
-                        for class_id, weight in zip(np.unique(in_labels), class_weight)}
+def get_scaled_class_weight(in_labels, classes_number, smoothing_coef=1.0, feature_range=(1, 5)):
+    """get_class_weight_proportional() min-max scaled into feature_range over the classes present in in_labels,
+    the absent ones get the minimum weight. The result is aligned to the label vocabulary (classes_number long)"""
+    return get_scaled_class_weight_from_freqs(get_label_freqs(in_labels, classes_number),
+                                              smoothing_coef=smoothing_coef,
+                                              feature_range=feature_range)
+
+
+def get_scaled_class_weight_from_freqs(in_label_freqs, smoothing_coef=1.0, feature_range=(1, 5)):
+    """get_scaled_class_weight() of the label frequencies by class id, e.g. counted over a streamed trainset"""
+    from sklearn.preprocessing import MinMaxScaler
 
-    return class_weight_map
+    label_weights = get_class_weight_proportional_from_freqs(in_label_freqs, smoothing_coef=smoothing_coef)
+    present = 0 < label_weights
+    scaled_weights = np.full(label_weights.shape, feature_range[0], dtype=np.float64)
+    scaler = MinMaxScaler(feature_range=feature_range)
+    scaled_weights[present] = scaler.fit_transform(label_weights[present].reshape(-1, 1)).flatten()
+    return scaled_weights
+
+
+def sample_weighted(in_cumulative_weights, in_size):
+    """Sampling with replacement by a binary search of uniform draws in the precomputed cumulative weights:
+    O(in_size * log N) instead of np.random.choice()'s O(N) per call"""
+    return np.searchsorted(in_cumulative_weights,
+                           np.random.random(in_size) * in_cumulative_weights[-1],
+                           side='right')
 
 
 def random_batch_generator(data, labels, batch_size, sample_probabilities=None):
-    data_idx = range(labels.shape[0])
+    """data and labels can be memory-mapped: only the sampled rows are read, in file order"""
+    if sample_probabilities is not None:
+        cumulative_probabilities = np.cumsum(sample_probabilities)
     while True:
-        batch_idx = np.random.choice(data_idx, size=batch_size, p=sample_probabilities)
+        if sample_probabilities is None:
+            batch_idx = np.random.randint(labels.shape[0], size=batch_size)
+        else:
+            batch_idx = sample_weighted(cumulative_probabilities, batch_size)
+        batch_idx.sort()
         batch = (np.take(data, batch_idx, axis=0), np.take(labels, batch_idx, axis=0))
         yield batch
 
@@ -49,31 +113,48 @@ def dynamic_importance_sampling_random_batch_generator(data,
                                                        batch_size,
                                                        smoothing_coef_min,
                                                        smoothing_coef_max):
-    labels_flat = np.argmax(labels, axis=-1)
-
-    sample_probs = np.ones(labels.shape[0])
-    data_idx = range(labels.shape[0])
+    """Samples are weighted by get_class_weight_proportional() of their labels, with the smoothing
+    coefficient oscillating between smoothing_coef_max and smoothing_coef_min every 1000 batches.
+    Equivalently (and in O(batch_size) per batch), a class c of frequency f_c is drawn with
+    the probability proportional to f_c * f_c ** (-1 / smoothing_coef), then a sample of it uniformly"""
+    class_freqs = np.bincount(labels)
+    classes = np.flatnonzero(class_freqs)
+    class_freqs = class_freqs[classes].astype(np.float64)
+    # sample indices grouped by class, and every class's start in them
+    class_samples = np.argsort(labels, kind='mergesort')
+    class_starts = np.concatenate([[0], np.cumsum(class_freqs[:-1])]).astype(np.int64)
     x = 0.0
     delta = smoothing_coef_min - smoothing_coef_max
     batch_counter = 0
     while True:
         if batch_counter == 0:
-            class_weight = get_class_weight_proportional(labels_flat, smoothing_coef=smoothing_coef_min + delta * abs(sin(x)))
-            sample_weight = get_sample_weight(labels_flat, class_weight)
-            sample_probs = sample_weight / sum(sample_weight)
+            smoothing_coef = smoothing_coef_min + delta * abs(sin(x))
+            cumulative_class_probs = np.cumsum(np.power(class_freqs, 1.0 - 1.0 / smoothing_coef))
             x = (x + 0.1) % (2 * pi)
         batch_counter = (batch_counter + 1) % 1000
-        batch_idx = np.random.choice(data_idx, size=batch_size, p=sample_probs)
+        batch_classes = sample_weighted(cumulative_class_probs, batch_size)
+        batch_class_idx = (np.random.random(batch_size) * class_freqs[batch_classes]).astype(np.int64)
+        batch_idx = np.sort(class_samples[class_starts[batch_classes] + batch_class_idx])
         batch = (np.take(data, batch_idx, axis=0), np.take(labels, batch_idx, axis=0))
         yield batch
 
 
-def batch_generator(X, y_for_tasks, batch_size):
+def batch_generator(X, y_for_tasks, batch_size, verbose=True, shuffle=False):
+    """Batches are slices, i.e. views of X and y_for_tasks: no copying if they're memory-mapped.
+    With shuffle, it's one epoch in a random order (see shuffled_batch_generator())"""
+    if shuffle:
+        for batch in shuffled_batch_generator(X, y_for_tasks, batch_size, verbose=verbose):
+            yield batch
+        return
+    if isinstance(X, tuple):
+        for batch in sequence_batch_generator(X, y_for_tasks, batch_size, verbose=verbose):
+            yield batch
+        return
     batch_start_idx = 0
     total_batches_number = X.shape[0] / batch_size
     batch_counter = 0
     while batch_start_idx < X.shape[0]:
-        if batch_counter % 1000 == 0:
+        if verbose and batch_counter % 1000 == 0:
             print 'Processed {} out of {} batches'.format(batch_counter, total_batches_number)
         batch = (X[batch_start_idx: batch_start_idx + batch_size],
                  [y_i[batch_start_idx: batch_start_idx + batch_size] for y_i in y_for_tasks])
@@ -82,27 +163,180 @@ def batch_generator(X, y_for_tasks, batch_size):
         yield batch
 
 
+def sequence_batch_generator(X, y_for_tasks, batch_size, verbose=True):
+    """Batches of batch_size utterances from a sequence-level dataset:
+    X is (padded utterances, lengths), y_for_tasks are per-token labels.
+    Every batch is trimmed to its longest utterance"""
+    X_padded, lengths = X
+    token_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    total_batches_number = X_padded.shape[0] / batch_size
+    for batch_counter, batch_start_idx in enumerate(xrange(0, X_padded.shape[0], batch_size)):
+        if verbose and batch_counter % 1000 == 0:
+            print 'Processed {} out of {} batches'.format(batch_counter, total_batches_number)
+        batch_end_idx = min(batch_start_idx + batch_size, X_padded.shape[0])
+        batch_lengths = lengths[batch_start_idx: batch_end_idx]
+        batch_x = (X_padded[batch_start_idx: batch_end_idx, :max(np.max(batch_lengths), 1)], batch_lengths)
+        token_start_idx, token_end_idx = token_offsets[batch_start_idx], token_offsets[batch_end_idx]
+        batch = (batch_x, [y_i[token_start_idx: token_end_idx] for y_i in y_for_tasks])
+        yield batch
+
+
+def shuffled_batch_generator(X, y_for_tasks, batch_size, verbose=True):
+    """One epoch over the dataset in a new random order.
+    Windowed contexts all have the same length, so they are just permuted.
+    Sequence-level utterances are sorted by length with random tie-breaking and cut into batches
+    which are then shuffled, so that each batch holds utterances of similar lengths (minimal padding).
+    The O(N) reordering is done once per epoch, every batch then costs O(batch_size)"""
+    if isinstance(X, tuple):
+        X_padded, lengths = X
+        token_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        order = np.lexsort((np.random.random(lengths.shape[0]), lengths))
+    else:
+        order = np.random.permutation(X.shape[0])
+    batch_starts = np.random.permutation(np.arange(0, order.shape[0], batch_size))
+    total_batches_number = order.shape[0] / batch_size
+    for batch_counter, batch_start_idx in enumerate(batch_starts):
+        if verbose and batch_counter % 1000 == 0:
+            print 'Processed {} out of {} batches'.format(batch_counter, total_batches_number)
+        batch_idx = order[batch_start_idx: batch_start_idx + batch_size]
+        if not isinstance(X, tuple):
+            batch_idx = np.sort(batch_idx)
+            yield np.take(X, batch_idx, axis=0), [np.take(y_i, batch_idx, axis=0) for y_i in y_for_tasks]
+            continue
+        batch_lengths = lengths[batch_idx]
+        batch_x = (np.take(X_padded[:, :max(np.max(batch_lengths), 1)], batch_idx, axis=0), batch_lengths)
+        # the tokens of the batch utterances, in the order the model flattens its outputs
+        batch_token_starts = token_offsets[batch_idx] - np.concatenate([[0], np.cumsum(batch_lengths)[:-1]])
+        token_idx = np.repeat(batch_token_starts, batch_lengths) + np.arange(np.sum(batch_lengths))
+        yield batch_x, [np.take(y_i, token_idx, axis=0) for y_i in y_for_tasks]
+
+
+def stream_batch_generator(in_dataset_file,
+                           in_vocab,
+                           in_label_vocab,
+                           in_config,
+                           batch_size,
+                           chunk_size=8192):
+    """Fixed-size (X, ys) batches vectorised straight from a dataset file, chunk_size utterances at a time,
+    so that the memory used doesn't depend on the dataset size (see iterate_dataset_file())"""
+    is_sequence_model = in_config.get('model_type', 'windowed') == 'sequence'
+    if is_sequence_model:
+        # sequence batches are made of utterances, so that the chunks split into whole batches
+        chunk_size = max(chunk_size / batch_size, 1) * batch_size
+    rows = iterate_dataset_file(in_dataset_file, chunk_size=chunk_size)
+    X_rest, ys_rest = None, None
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        tokens, pos, tags = zip(*chunk)
+        token_ids, lengths = vectorize_rows(tokens, pos, in_vocab, in_config)
+        X = make_model_input(token_ids, lengths, in_config)
+        ys_for_tasks = make_task_labels(tags, token_ids, lengths, in_label_vocab, in_config)
+        if is_sequence_model:
+            for batch in sequence_batch_generator(X, ys_for_tasks, batch_size, verbose=False):
+                yield batch
+            continue
+        # windowed batches are made of tokens, the ones left over are carried to the next chunk
+        if X_rest is not None:
+            X = np.concatenate([X_rest, X])
+            ys_for_tasks = [np.concatenate([y_rest_i, y_i]) for y_rest_i, y_i in zip(ys_rest, ys_for_tasks)]
+        full_batches_size = X.shape[0] / batch_size * batch_size
+        for batch_start_idx in xrange(0, full_batches_size, batch_size):
+            yield (X[batch_start_idx: batch_start_idx + batch_size],
+                   [y_i[batch_start_idx: batch_start_idx + batch_size] for y_i in ys_for_tasks])
+        X_rest, ys_rest = X[full_batches_size:], [y_i[full_batches_size:] for y_i in ys_for_tasks]
+    if X_rest is not None and X_rest.shape[0]:
+        yield X_rest, ys_rest
+
+
+def prepare_batch(in_batch):
+    """In-memory copies of the batch arrays (e.g. of memory-mapped slices), ready to be fed to the model"""
+    batch_x, batch_y = in_batch
+    if isinstance(batch_x, tuple):
+        batch_x = tuple(np.array(x_i) for x_i in batch_x)
+    else:
+        batch_x = np.array(batch_x)
+    return batch_x, [np.array(y_i) for y_i in batch_y]
+
+
+def prefetch_generator(in_generator, buffer_size=DEFAULT_PREFETCH_BATCHES):
+    """Runs in_generator on a background thread, keeping up to buffer_size of its items ready.
+    The thread stops once the consumer does (e.g. on an error, or when the generator is closed),
+    and its errors are re-raised to the consumer with the original traceback"""
+    queue = Queue(maxsize=buffer_size)
+    end_of_data = object()
+    stopped = Event()
+    error_info = []
+
+    def put(in_item):
+        """False if the consumer has stopped"""
+        while not stopped.is_set():
+            try:
+                queue.put(in_item, timeout=PREFETCH_PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in in_generator:
+                if not put(item):
+                    return
+        except Exception:
+            error_info.extend(sys.exc_info())
+        put(end_of_data)
+
+    producer = Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end_of_data:
+                break
+            yield item
+    finally:
+        stopped.set()
+    if error_info:
+        raise error_info[0], error_info[1], error_info[2]
+
+
 def get_loss_function(in_logits_for_tasks,
                       in_labels_for_tasks,
                       in_class_weights_for_tasks,
                       l2_coef=0.0,
                       weight_change_penalization_coef=0.0,
-                      task_weights=None):
+                      task_weights=None,
+                      task_losses=None,
+                      num_sampled=512,
+                      hidden=None,
+                      lengths=None):
+    """hidden: the model's last hidden layer (see create_model()), needed by the sampled task losses.
+    lengths: the utterance lengths of a sequence model's batch (see create_sequence_model()).
+    The task losses are summed over a windowed batch, i.e. over its batch_size tokens. A sequence batch
+    holds batch_size utterances instead, so its loss is averaged per real token and scaled by batch_size:
+    the same config gives the same loss and gradient scale for both model types"""
     assert len(in_logits_for_tasks) == len(in_labels_for_tasks) == len(task_weights)
     if task_weights == None:
         task_weights = np.ones(len(in_logits_for_tasks))
-    eps = tf.constant(value=np.finfo(np.float32).eps, dtype=tf.float32)
+    if task_losses is None:
+        task_losses = ['softmax'] * len(in_logits_for_tasks)
 
     losses = []
-    for logits, labels, class_weights in zip(in_logits_for_tasks,
-                                             in_labels_for_tasks,
-                                             in_class_weights_for_tasks):
+    for task_idx, (logits, labels, class_weights, task_loss) in enumerate(zip(in_logits_for_tasks,
+                                                                             in_labels_for_tasks,
+                                                                             in_class_weights_for_tasks,
+                                                                             task_losses)):
         class_weights_i = tf.constant(value=class_weights, dtype=tf.float32)
-        logits_i = logits + eps
-        softmax_i = tf.nn.softmax(logits_i)
-        loss_xent_i = -tf.reduce_sum(tf.multiply(labels * tf.log(softmax_i + eps), class_weights_i),
-                                     reduction_indices=[1])
-        losses.append(loss_xent_i)
+        if task_loss == 'softmax':
+            loss_xent_i = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
+        else:
+            if hidden is None:
+                raise ValueError('The {} loss needs the model\'s hidden layer'.format(task_loss))
+            loss_xent_i = get_sampled_loss(task_idx, hidden, labels, num_sampled, loss_type=task_loss)
+        losses.append(loss_xent_i * tf.gather(class_weights_i, labels))
     # loss_xent = tf.nn.softmax_cross_entropy_with_logits_v2(labels=in_labels, logits=in_logits)
     # Add regularization loss as well
     loss_l2 = tf.reduce_sum([tf.nn.l2_loss(v)
@@ -112,14 +346,39 @@ def get_loss_function(in_logits_for_tasks,
     graph = tf.get_default_graph()
     # L2 regularization on model weights trajectory
     weight_change_l2s = []
-    for v in tf.trainable_variables():
-        v_initial = graph.get_tensor_by_name(v.name.partition(':')[0] + '_initial:' + v.name.partition(':')[1])
-        weight_change_l2s.append(tf.nn.l2_loss(tf.subtract(v, v_initial)))
+    if weight_change_penalization_coef:
+        for v in tf.trainable_variables():
+            v_initial = graph.get_tensor_by_name(v.name.partition(':')[0] + '_initial:' + v.name.partition(':')[2])
+            weight_change_l2s.append(tf.nn.l2_loss(tf.subtract(v, v_initial)))
     loss_weight_change = tf.reduce_sum(weight_change_l2s) * weight_change_penalization_coef
 
     losses_weighted = [loss_i * task_weight_i
                        for loss_i, task_weight_i in zip(losses, task_weights)]
-    cost = tf.reduce_mean(tf.add(tf.reduce_sum(losses_weighted), loss_l2, loss_weight_change),
+    loss_tasks = tf.reduce_sum(losses_weighted)
+    if lengths is not None:
+        tokens_number = tf.cast(tf.maximum(tf.reduce_sum(lengths), 1), tf.float32)
+        loss_tasks = loss_tasks * tf.cast(tf.size(lengths), tf.float32) / tokens_number
+    cost = tf.reduce_mean(tf.add_n([loss_tasks, loss_l2, loss_weight_change]),
                           name='cost')
 
-    return cost
\ No newline at end of file
+    return cost
+
+
+def get_sampled_loss(in_task_idx, in_hidden, in_labels, in_num_sampled, loss_type='sampled_softmax'):
+    """Training-time approximation of the task's full softmax loss (for large output layers, e.g. the LM head).
+    Uses the model's hidden layer and the task's output projection W_<task_idx>, bias_<task_idx>"""
+    with tf.variable_scope('model', reuse=True):
+        W = tf.get_variable('W_{}'.format(in_task_idx))
+        b = tf.get_variable('bias_{}'.format(in_task_idx))
+    if loss_type == 'sampled_softmax':
+        loss_function = tf.nn.sampled_softmax_loss
+    elif loss_type == 'nce':
+        loss_function = tf.nn.nce_loss
+    else:
+        raise NotImplementedError
+    return loss_function(weights=tf.transpose(W),
+                         biases=b,
+                         labels=tf.expand_dims(tf.cast(in_labels, tf.int64), -1),
+                         inputs=in_hidden,
+                         num_sampled=in_num_sampled,
+                         num_classes=W.shape[1].value)